@@ -0,0 +1,317 @@
+# -------------------------------
+# HHORIZONS BENCHMARKS
+# -------------------------------
+
+# This file measures how fast the parts of main.py and DataAnalysis.py which handle every reading run, so a change
+# which slows them down can be found and the sample rate of the Astro Pi can be chosen. The readings are taken from
+# the synthetic backend in Hardware.py, so no Astro Pi is needed, and the analysis is run on synthetic data files of
+# any number of rows, which are made with a fixed seed so every run of the benchmarks uses the same data. The results
+# are written as JSON, so the results of two versions of the code can be compared. For example
+# python Benchmark.py --sizes 10000,100000,1000000 --output benchmark.json
+# runs every benchmark with data files of 10 thousand, 100 thousand and 1 million rows.
+
+# -------------------------------
+# IMPORTS
+# -------------------------------
+
+import argparse  # Allows the benchmarks to be chosen when the program is started
+import io  # Allows the plots to be saved in memory instead of to a file
+import json  # Allows us to write the results as JSON
+import platform  # Allows us to record the computer the benchmarks were run on
+import statistics  # Allows us to work out the median time of each benchmark
+import subprocess  # Allows us to record the version of the code the benchmarks were run on
+import sys  # Allows us to write the results to the screen
+import tempfile  # Allows us to write the data files of the acquisition benchmarks to a folder which is deleted after
+import time  # Allows us to time each benchmark
+from datetime import datetime  # Allows us to record when the benchmarks were run
+from pathlib import Path  # Allows us to find the data files
+import numpy as np  # Allows us to make the synthetic data files quickly
+import pandas as pd  # Allows us to write the synthetic data files
+import matplotlib  # Allows us to draw the plots without a screen
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt  # Allows us to close the plots after they are drawn
+import DataAnalysis  # The analysis which is timed
+import Hardware  # The synthetic backend the readings are taken from
+from Displacement import DisplacementIntegrator  # Allows us to work out the displacement in the synthetic data files
+from Spline import WindowedSpline  # The spline which is timed
+
+# -------------------------------
+# SETTINGS
+# -------------------------------
+
+# SIZES is the number of rows in each synthetic data file the analysis benchmarks are run on
+# SAMPLES is how many readings are taken in each acquisition benchmark
+# REPEAT is how many times each benchmark is run, the fastest and median time are reported
+# LOOP_SECONDS is how long main.py is run for in the benchmark of the whole acquisition loop
+# DATA_FOLDER is where the synthetic data files are kept, so they are only made once for each size and seed
+# SEED is the seed of the random numbers in the synthetic data files
+# SAMPLE_RATE is the accelerometer rate of the synthetic data files, the position changes once a second
+SIZES = [10000, 100000, 1000000]
+SAMPLES = 20000
+REPEAT = 3
+LOOP_SECONDS = 5
+DATA_FOLDER = Path(__file__).parent.resolve() / "BenchmarkData"
+SEED = 2023
+SAMPLE_RATE = 50
+
+# -------------------------------
+# TIMING
+# -------------------------------
+
+# Runs function repeat times and returns the fastest and median time it took in seconds, and what it returned the
+# last time it was run
+def timed(function, repeat=REPEAT):
+    times = []
+    result = None
+    for run in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return {"best_seconds": min(times), "median_seconds": statistics.median(times)}, result
+
+
+# Adds the rate of a benchmark which handled count items to its timing
+def with_rate(timing, count, name):
+    timing[name + "_per_second"] = count / timing["best_seconds"] if timing["best_seconds"] else None
+    timing["microseconds_per_" + name.rstrip("s")] = timing["best_seconds"] / count * 1e6 if count else None
+    return timing
+
+# -------------------------------
+# SYNTHETIC DATA FILES
+# -------------------------------
+
+# Makes a data file of rows readings in the same format as the data.csv written by main.py, with readings taken
+# SAMPLE_RATE times a second, magnetometer readings which change along the orbit with noise added, and the position
+# of the ISS from the synthetic orbit in Hardware.py at the time of every reading, like the positions main.py works
+# out for every row. It is written in chunks so a large file is never held in memory
+# all at once, and returns the path of the file, which is only made if it does not already exist. Each chunk is
+# integrated together with the last reading of the chunk before it, and the velocity of that reading is added to the
+# chunk, so the displacement is the same as if the whole file had been integrated at once.
+def make_dataset(rows, seed=SEED, folder=DATA_FOLDER, chunk_size=1000000):
+    path = Path(folder) / ("synthetic-" + str(rows) + "-" + str(seed) + ".csv")
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    generator = np.random.default_rng(seed)
+    start = np.datetime64("2023-04-20T10:00:00", "us")
+    partial = path.with_suffix(".part")
+    previous = None
+    for first in range(0, rows, chunk_size):
+        count = min(chunk_size, rows - first)
+        elapsed = (first + np.arange(count)) / SAMPLE_RATE
+        DateTime = np.datetime_as_string(start + (elapsed * 1e6).astype("timedelta64[us]"))
+        phase = 2 * np.pi * elapsed / Hardware.ORBIT_PERIOD
+        mag = np.column_stack([20 * np.sin(phase), 15 * np.cos(phase), -30 + 10 * np.sin(2 * phase)])
+        mag = mag + generator.normal(0, 0.5, (count, 3))
+        acc = generator.normal(0, 0.01, (count, 3))
+        if previous is None:
+            velocity, displacement = DisplacementIntegrator.integrate(elapsed, acc, "flight")
+        else:
+            previous_time, previous_acc, previous_velocity = previous
+            velocity, displacement = DisplacementIntegrator.integrate(np.concatenate([[previous_time], elapsed]),
+                                                                      np.vstack([previous_acc, acc]), "flight")
+            intervals = np.diff(np.concatenate([[previous_time], elapsed]))[:, None]
+            velocity = velocity[1:] + previous_velocity
+            displacement = displacement[1:] + previous_velocity * intervals
+        previous = (elapsed[-1], acc[-1], velocity[-1])
+        latitude, longitude, elevation = synthetic_positions(elapsed)
+        data = pd.DataFrame({"DateTime": np.char.replace(DateTime, "T", " "),
+                             "Mag X": mag[:, 0], "Mag Y": mag[:, 1], " Mag Z": mag[:, 2],
+                             "Mag Magnitude": np.sqrt((mag ** 2).sum(axis=1)),
+                             "Acc X": acc[:, 0], "Acc Y": acc[:, 1], "Acc Z": acc[:, 2],
+                             "Displacement X": displacement[:, 0], "Displacement Y": displacement[:, 1],
+                             "Displacement Z": displacement[:, 2],
+                             "ISS Latitude": latitude, "ISS Longitude": longitude, "ISS Elevation": elevation})
+        data.to_csv(partial, mode="w" if first == 0 else "a", header=first == 0, index=False)
+    partial.replace(path)
+    return path
+
+
+# Returns the latitude and longitude as text and the elevation of the synthetic orbit at each of the seconds given
+def synthetic_positions(seconds):
+    phase = 2 * np.pi * seconds / Hardware.ORBIT_PERIOD
+    inclination = np.radians(Hardware.ORBIT_INCLINATION)
+    latitude = np.degrees(np.arcsin(np.sin(inclination) * np.sin(phase)))
+    longitude = np.degrees(np.arctan2(np.cos(inclination) * np.sin(phase), np.cos(phase)))
+    longitude = (longitude - 360 * seconds / Hardware.EARTH_ROTATION_PERIOD + 180) % 360 - 180
+    elevation = Hardware.ORBIT_ELEVATION + 5 * np.sin(phase)
+    return angle_text(latitude), angle_text(longitude), elevation
+
+
+# Returns the angles given in degrees as the same text as Hardware.Angle, made for every angle at once because a
+# position is made for every reading
+def angle_text(degrees):
+    tenths = pd.Series(np.round(np.abs(degrees) * 36000).astype(np.int64))
+    sign = pd.Series(np.where(degrees < 0, "-", ""))
+    text = (sign + (tenths // 36000).astype(str).str.zfill(2) + "deg " + (tenths // 600 % 60).astype(str).str.zfill(2) +
+            "' " + (tenths // 10 % 60).astype(str).str.zfill(2) + "." + (tenths % 10).astype(str) + '"')
+    return text.to_numpy()
+
+# -------------------------------
+# ACQUISITION BENCHMARKS
+# -------------------------------
+
+# Times how long main.py takes to take, work out and write each reading, using the synthetic backend. main.py is
+# imported here so its settings can be used, and the variables its functions use are set up in the same way as its
+# main function does.
+def benchmark_acquisition(samples=SAMPLES, repeat=REPEAT):
+    import main
+    main.sense, main.iss = Hardware.create_backend("synthetic", seed=SEED)
+    main.run_log = main.RunLog(verbose=False)
+    main.integrator = DisplacementIntegrator()
+    for reading in range(2):
+        acc = main.sense.get_accelerometer_raw()
+        main.integrator.update([acc["x"], acc["y"], acc["z"]], time.time())
+    location = main.iss.coordinates()
+    results = {}
+    timing, sample = timed(lambda: [main.read_sensors() for reading in range(samples)], repeat)
+    results["read_sensors"] = with_rate(timing, samples, "samples")
+    timing, rows = timed(lambda: [main.derive_data(reading, location) for reading in sample], repeat)
+    results["derive_data"] = with_rate(timing, samples, "samples")
+    timing, rows = timed(lambda: [main.get_sense_data() for reading in range(samples)], repeat)
+    results["get_sense_data"] = with_rate(timing, samples, "samples")
+    timing, location = timed(lambda: [main.iss.coordinates() for reading in range(samples)], repeat)
+    results["iss_coordinates"] = with_rate(timing, samples, "samples")
+    with tempfile.TemporaryDirectory() as folder:
+        for name, writer_class, file_name in (("csv_writer", main.DataWriter, "data.csv"),
+                                              ("binary_writer", main.BinaryDataWriter, "data.bin")):
+            def write():
+                data_writer = writer_class(Path(folder) / file_name, header=main.DATA_HEADER)
+                for row in rows:
+                    data_writer.add_row(row)
+                data_writer.close()
+                return data_writer.size
+            timing, size = timed(write, repeat)
+            results[name] = with_rate(timing, samples, "rows")
+            results[name]["bytes_per_row"] = size / samples
+    return results
+
+
+# Runs the whole of main.py for seconds with the synthetic backend, taking readings as fast as possible, and returns
+# the rows written a second in each acquisition mode and recording format
+def benchmark_loop(seconds=LOOP_SECONDS):
+    import main
+    results = {}
+    for mode in ("loop", "pipeline"):
+        for recording_format in ("csv", "binary"):
+            with tempfile.TemporaryDirectory() as folder:
+                summary = main.main(["--backend", "synthetic", "--rate", "0", "--mode", mode, "--format",
+                                     recording_format, "--minutes", str(seconds / 60), "--output", folder])
+            duration = (datetime.fromisoformat(summary["finish_time"]) -
+                        datetime.fromisoformat(summary["start_time"])).total_seconds()
+            results[mode + "_" + recording_format] = {"rows_written": summary["rows_written"],
+                                                      "seconds": duration,
+                                                      "rows_per_second": summary["rows_written"] / duration,
+                                                      "errors": summary["log"]["errors"]}
+            if "pipeline" in summary:
+                results[mode + "_" + recording_format]["pipeline"] = summary["pipeline"]
+    return results
+
+# -------------------------------
+# ANALYSIS BENCHMARKS
+# -------------------------------
+
+# Times each step of DataAnalysis.py on the data file at path. The steps are timed one at a time on the columns they
+# use, so each time only includes that step.
+def benchmark_analysis(path, repeat=REPEAT, distance_methods=("haversine",)):
+    results = {}
+    timing, raw = timed(lambda: pd.read_csv(path, dtype=str), 1)
+    rows = len(raw)
+    results["read_csv"] = with_rate(timing, rows, "rows")
+    timing, DateTime = timed(lambda: DataAnalysis.parse_timestamps(raw["DateTime"]), repeat)
+    results["parse_timestamps"] = with_rate(timing, rows, "rows")
+    timing, data = timed(lambda: DataAnalysis.read_data(path), 1)
+    results["read_data"] = with_rate(timing, rows, "rows")
+    timing, latitude = timed(lambda: DataAnalysis.dms_to_decimal(data.ISSLatitude), repeat)
+    results["dms_to_decimal"] = with_rate(timing, rows, "rows")
+    longitude = DataAnalysis.dms_to_decimal(data.ISSLongitude)
+    for method in distance_methods:
+        timing, distance = timed(lambda: DataAnalysis.distance_travelled(latitude, longitude, data.ISSElevation,
+                                                                         method), repeat)
+        results["distance_" + method] = with_rate(timing, rows, "rows")
+    distance = DataAnalysis.distance_travelled(latitude, longitude, data.ISSElevation)
+    timing, spline = timed(lambda: WindowedSpline.fit(distance, data.MagMagnitude, jobs=1), repeat)
+    results["spline_fit"] = with_rate(timing, rows, "rows")
+    timing, spline = timed(lambda: WindowedSpline.fit(distance, data.MagMagnitude, jobs=0), repeat)
+    results["spline_fit_parallel"] = with_rate(timing, rows, "rows")
+    times = (data.DateTime - data.DateTime.iloc[0]).dt.total_seconds().to_numpy()
+    accelerations = np.column_stack([data.AccX, data.AccY, data.AccZ])
+    timing, integrated = timed(lambda: DisplacementIntegrator.integrate(times, accelerations, "trapezoid"), repeat)
+    results["displacement"] = with_rate(timing, rows, "rows")
+    dataset = DataAnalysis.Dataset(str(path))
+    dataset.load()
+    dataset.derived.update({"DecimalLatitude": latitude, "DecimalLongitude": longitude,
+                            "DistanceTravelled": distance})
+    for name, plot in DataAnalysis.PLOTS.items():
+        def draw():
+            fig = plot(dataset)
+            fig.savefig(io.BytesIO(), format="png")
+            plt.close(fig)
+        timing, nothing = timed(draw, repeat)
+        results["plot_" + name] = with_rate(timing, rows, "rows")
+    return results
+
+# -------------------------------
+# RUNNING THE BENCHMARKS
+# -------------------------------
+
+# Returns the git commit the code is at, or None if it is not in a git repository
+def code_version():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Time the acquisition and analysis of the HHorizons readings.")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in SIZES),
+                        help="comma separated numbers of rows of the synthetic data files")
+    parser.add_argument("--samples", type=int, default=SAMPLES, help="readings taken in each acquisition benchmark")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="times each benchmark is run")
+    parser.add_argument("--loop-seconds", type=float, default=LOOP_SECONDS,
+                        help="seconds main.py is run for in each loop benchmark, 0 skips them")
+    parser.add_argument("--distance-methods", default="haversine",
+                        help="comma separated distance methods to time, from " + ", ".join(
+                            DataAnalysis.DISTANCE_METHODS))
+    parser.add_argument("--data-folder", default=DATA_FOLDER, help="folder the synthetic data files are kept in")
+    parser.add_argument("--skip", default="", help="comma separated benchmarks to skip, from acquisition, loop, "
+                                                    "analysis")
+    parser.add_argument("--output", help="file the JSON results are written to, as well as the screen")
+    arguments = parser.parse_args(argv)
+    arguments.sizes = [int(size) for size in arguments.sizes.split(",") if size.strip()]
+    arguments.distance_methods = [method.strip() for method in arguments.distance_methods.split(",")
+                                  if method.strip()]
+    arguments.skip = [name.strip() for name in arguments.skip.split(",") if name.strip()]
+    return arguments
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    results = {"created": datetime.now().isoformat(), "code_version": code_version(),
+               "python": platform.python_version(), "platform": platform.platform(),
+               "processor": platform.processor() or platform.machine(),
+               "settings": {"samples": arguments.samples, "repeat": arguments.repeat, "seed": SEED,
+                            "sample_rate": SAMPLE_RATE, "loop_seconds": arguments.loop_seconds}}
+    if "acquisition" not in arguments.skip:
+        results["acquisition"] = benchmark_acquisition(arguments.samples, arguments.repeat)
+    if "loop" not in arguments.skip and arguments.loop_seconds > 0:
+        results["loop"] = benchmark_loop(arguments.loop_seconds)
+    if "analysis" not in arguments.skip:
+        results["analysis"] = {}
+        for size in arguments.sizes:
+            start = time.perf_counter()
+            path = make_dataset(size, folder=arguments.data_folder)
+            results["analysis"][str(size)] = {"make_dataset_seconds": time.perf_counter() - start}
+            results["analysis"][str(size)].update(benchmark_analysis(path, arguments.repeat,
+                                                                     arguments.distance_methods))
+    text = json.dumps(results, indent=1)
+    if arguments.output:
+        Path(arguments.output).write_text(text)
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
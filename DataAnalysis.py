@@ -1,141 +1,812 @@
 import sys
+import argparse
+from pathlib import Path
 import numpy as np
 import pandas as pd
-from scipy.interpolate import UnivariateSpline
 import matplotlib.pyplot as plt
 import geopy.distance
 from dateutil import parser
 from csv import writer
 import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from Displacement import DisplacementIntegrator, SCHEMES
+from Spline import cached_spline, evaluation_grid
 
 
-def menu(location):
-    data = pd.read_csv(location)
-    Longitude = data.ISSLongitude
-    Latitude = data.ISSLatitude
-    Elevation = data.ISSElevation
-    Magnetometer = data.MagMagnitude
-    MagX = data.MagX
-    MagY = data.MagY
-    MagZ = data.MagZ
-    DateTime = data.DateTime
-    os.system("cls")
-    print("--------------------------------MENU------------------------------------")
-    print("1) Plot graph of raw magnetic field strength against distance travelled")
-    print("2) Format longitude and latitude from degrees to decimal")
-    print("3) Get distance travelled of the ISS from longitude and latitude")
-    print("4) Create univariate interpolated spline of raw data and plot graph")
-    print("5) Plot graph of elevation against time")
-    print("6) Plot magnetic field strength against time")
-    print("7) Plot magnetic field strength in 3D")
-    print("8) End program")
-    UserChoice = input("Enter your choice: ")
-    if UserChoice == "1":
-        option1(Magnetometer,location)
-    elif UserChoice == "2":
-        option2(Longitude, Latitude, location)
-    elif UserChoice == "3":
-        option3(Latitude, Longitude, location)
-    elif UserChoice == "4":
-        option4(Magnetometer, location)
-    elif UserChoice == "5":
-        option5(Elevation, DateTime, location)
-    elif UserChoice == "6":
-        option6(DateTime,Magnetometer, location)
-    elif UserChoice == "7":
-        option7(MagX,MagY,MagZ,location)
-    elif UserChoice == "8":
-        sys.exit()
-
-
-def option1(Magnetometer,Location):
-    data = pd.read_csv(location)
-    DistanceTravelled = data.DistanceTravelled
-    plt.plot(DistanceTravelled, Magnetometer, label="Raw Data")
+COLUMN_TYPES = {"DateTime": "str", "MagX": "float64", "MagY": "float64", "MagZ": "float64",
+                "MagMagnitude": "float64", "AccX": "float64", "AccY": "float64", "AccZ": "float64",
+                "DisplacementX": "float64", "DisplacementY": "float64", "DisplacementZ": "float64",
+                "ISSLatitude": "str", "ISSLongitude": "str", "ISSElevation": "float64", "DistanceTravelled": "float64"}
+
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def column_name(name):
+    return name.replace(" ", "")
+
+
+def read_data(location):
+    header = pd.read_csv(location, nrows=0).columns
+    dtypes = {name: COLUMN_TYPES[column_name(name)] for name in header if column_name(name) in COLUMN_TYPES}
+    data = pd.read_csv(location, dtype=dtypes)
+    data.columns = [column_name(name) for name in data.columns]
+    data["DateTime"] = parse_timestamps(data["DateTime"])
+    return data
+
+
+def parse_timestamps(DateTime):
+    Parsed = pd.to_datetime(DateTime, format=DATETIME_FORMAT, errors="coerce")
+    Failed = Parsed.isna() & DateTime.notna()
+    if Failed.any():
+        Cache = {}
+        for Text in DateTime[Failed].unique():
+            try:
+                Cache[Text] = parser.parse(Text)
+            except (ValueError, OverflowError):
+                Cache[Text] = pd.NaT
+        Parsed[Failed] = pd.to_datetime(DateTime[Failed].map(Cache))
+    return Parsed
+
+
+DMS_PATTERN = (r"^\s*(?P<Sign>[-+])?\s*(?P<Degrees>\d+(?:\.\d*)?)\s*(?:deg|°)"
+               r"(?:\s*(?P<Minutes>\d+(?:\.\d*)?)\s*')?"
+               r"(?:\s*(?P<Seconds>\d+(?:\.\d*)?)\s*\")?"
+               r"\s*(?P<Hemisphere>[NSEWnsew])?\s*$")
+
+
+def dms_to_decimal(Coordinates):
+    if pd.api.types.is_numeric_dtype(Coordinates):
+        return Coordinates.astype("float64")
+    Coordinates = Coordinates.astype("str").where(Coordinates.notna())
+    Decimal = pd.to_numeric(Coordinates, errors="coerce")
+    Parts = Coordinates.str.extract(DMS_PATTERN)
+    Magnitude = (Parts.Degrees.astype("float64") + Parts.Minutes.astype("float64").fillna(0) / 60 +
+                 Parts.Seconds.astype("float64").fillna(0) / (60 * 60))
+    Negative = Parts.Sign.eq("-").fillna(False) | Parts.Hemisphere.str.upper().isin(["S", "W"])
+    Magnitude = Magnitude.where(~Negative, -Magnitude)
+    return Decimal.fillna(Magnitude)
+
+
+def parse_failures(Coordinates, Decimal):
+    return Coordinates[Coordinates.notna() & Decimal.isna()]
+
+
+EARTH_RADIUS = 6371.0088
+DISTANCE_METHODS = ["haversine", "geodesic"]
+
+
+def haversine_distances(Latitude, Longitude, Radius):
+    Latitude = np.radians(Latitude)
+    Longitude = np.radians(Longitude)
+    a = (np.sin(np.diff(Latitude) / 2) ** 2 +
+         np.cos(Latitude[:-1]) * np.cos(Latitude[1:]) * np.sin(np.diff(Longitude) / 2) ** 2)
+    return 2 * Radius * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def geodesic_chunk(Points):
+    return [geopy.distance.geodesic((a, b), (c, d)).km for a, b, c, d in Points]
+
+
+def geodesic_distances(Latitude, Longitude, chunk_size=20000, jobs=0):
+    Points = np.column_stack([Latitude[:-1], Longitude[:-1], Latitude[1:], Longitude[1:]]).tolist()
+    Chunks = [Points[i:i + chunk_size] for i in range(0, len(Points), chunk_size)]
+    if jobs == 1 or len(Chunks) <= 1:
+        return np.array(geodesic_chunk(Points), dtype="float64")
+    with ProcessPoolExecutor(max_workers=jobs or None) as executor:
+        return np.array([Distance for Chunk in executor.map(geodesic_chunk, Chunks) for Distance in Chunk],
+                        dtype="float64")
+
+
+def distance_travelled(Latitude, Longitude, Elevation=None, method="haversine", Origin=None, jobs=0):
+    if method not in DISTANCE_METHODS:
+        raise ValueError("Unknown distance method " + repr(method) + ", expected one of " + ", ".join(DISTANCE_METHODS))
+    Start = 0.0 if Origin is None else Origin[3]
+    Valid = Latitude.notna() & Longitude.notna()
+    if not Valid.any():
+        return pd.Series(Start, index=Latitude.index, name="DistanceTravelled")
+    ValidLatitude = Latitude[Valid].to_numpy(dtype="float64")
+    ValidLongitude = Longitude[Valid].to_numpy(dtype="float64")
+    if Elevation is not None:
+        Height = Elevation[Valid].ffill().bfill().fillna(0 if Origin is None else Origin[2]).to_numpy(dtype="float64")
+    else:
+        Height = np.zeros(len(ValidLatitude))
+    if Origin is not None:
+        ValidLatitude = np.concatenate([[Origin[0]], ValidLatitude])
+        ValidLongitude = np.concatenate([[Origin[1]], ValidLongitude])
+        Height = np.concatenate([[Origin[2]], Height])
+    Radius = EARTH_RADIUS + (Height[:-1] + Height[1:]) / 2
+    if method == "geodesic":
+        Surface = geodesic_distances(ValidLatitude, ValidLongitude, jobs=jobs) * Radius / EARTH_RADIUS
+    else:
+        Surface = haversine_distances(ValidLatitude, ValidLongitude, Radius)
+    Segments = np.sqrt(Surface ** 2 + np.diff(Height) ** 2)
+    Cumulative = np.cumsum(Segments)
+    if Origin is None:
+        Cumulative = np.concatenate([[0.0], Cumulative])
+    Distance = pd.Series(np.nan, index=Latitude.index, name="DistanceTravelled")
+    Distance[Valid] = Cumulative
+    return Distance.ffill().fillna(0) / 1000 + Start
+
+
+SEGMENT_INDEX = "index.jsonl"
+
+
+def segment_index(location):
+    Folder = Path(location)
+    Entries = {}
+    try:
+        with open(Folder / SEGMENT_INDEX) as f:
+            for Line in f:
+                try:
+                    Entry = json.loads(Line)
+                except ValueError:
+                    continue
+                Entries[Entry.get("segment")] = Entry
+    except FileNotFoundError:
+        pass
+    Segments = sorted(Segment for Segment in Folder.glob("data-*.*") if Segment.suffix in (".csv", ".bin"))
+    return [(Segment, Entries.get(Segment.name)) for Segment in Segments]
+
+
+def segment_problem(Segment):
+    try:
+        if Segment.stat().st_size == 0:
+            return "empty segment"
+        if Segment.suffix == ".bin":
+            read_binary(str(Segment))
+            return None
+        with open(Segment, newline="") as f:
+            Header = f.readline()
+    except (OSError, ValueError) as e:
+        return f'{e.__class__.__name__}: {e}'
+    if not Header.endswith("\n") or not Header.startswith("DateTime"):
+        return "segment has no complete header"
+    return None
+
+
+def file_checksum(location, block_size=1024 * 1024):
+    Digest = hashlib.sha256()
+    with open(location, "rb") as f:
+        for Block in iter(lambda: f.read(block_size), b""):
+            Digest.update(Block)
+    return Digest.hexdigest()
+
+
+def binary_frame(records):
+    names = records.dtype.names
+    data = pd.DataFrame({column_name(name): np.asarray(records[name]) for name in names[1:]})
+    data.insert(0, "DateTime", pd.to_datetime(np.asarray(records[names[0]]).astype("datetime64[ns]")))
+    return data
+
+
+class Dataset:
+    def __init__(self, location, origin=None):
+        self.location = location
+        self.origin = origin
+        self.signature = None
+        self.data = None
+        self.derived = {}
+        self.problems = []
+        self.segments = {}
+
+    def load(self):
+        if os.path.isdir(self.location):
+            raise ValueError(self.location + " is a folder of segments, which is read one segment at a time")
+        stat = os.stat(self.location)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature != self.signature:
+            if self.location.endswith(".bin"):
+                self.data = binary_frame(read_binary(self.location))
+            else:
+                self.data = read_data(self.location)
+            self.derived = {}
+            self.signature = signature
+        return self.data
+
+    def cached(self):
+        try:
+            stat = os.stat(self.location)
+        except OSError:
+            return False
+        return self.signature == (stat.st_mtime_ns, stat.st_size)
+
+    def check(self):
+        if not os.path.isdir(self.location):
+            self.load()
+        elif not segment_index(self.location):
+            raise ValueError(self.location + " has no segments recorded by main.py")
+
+    def part_count(self):
+        return max(len(segment_index(self.location)), 1) if os.path.isdir(self.location) else 1
+
+    def parts(self):
+        if not os.path.isdir(self.location):
+            yield self
+            return
+        self.problems = []
+        Index = segment_index(self.location)
+        Names = {str(Segment) for Segment, Entry in Index}
+        self.segments = {Name: Part for Name, Part in self.segments.items() if Name in Names}
+        Origin = None
+        for Segment, Entry in Index:
+            Part = self.segment(Segment)
+            if Part.origin != Origin:
+                Part.origin = Origin
+                Part.derived.pop("DistanceTravelled", None)
+            Problem = None if Part.cached() else segment_problem(Segment)
+            if Problem is None:
+                try:
+                    Part.load()
+                except (OSError, ValueError) as e:
+                    Problem = f'{e.__class__.__name__}: {e}'
+            if Problem is not None:
+                self.problems.append(Segment.name + " skipped: " + Problem)
+                continue
+            yield Part
+            Origin = Part.end_position()
+
+    def segment(self, Segment):
+        Name = str(Segment)
+        if Name not in self.segments:
+            self.segments[Name] = Dataset(Name)
+        return self.segments[Name]
+
+    def end_position(self):
+        data = self.load()
+        Latitude = self.decimal_latitude()
+        Longitude = self.decimal_longitude()
+        Valid = Latitude.notna() & Longitude.notna()
+        if not Valid.any():
+            return self.origin
+        Last = Valid[Valid].index[-1]
+        Height = data.ISSElevation[Valid].ffill()[Last]
+        if Height != Height:
+            Height = 0.0 if self.origin is None else self.origin[2]
+        return Latitude[Last], Longitude[Last], Height, self.distance_travelled()[Last]
+
+    def derive(self, name, function):
+        data = self.load()
+        if name not in self.derived:
+            self.derived[name] = function(data)
+        return self.derived[name]
+
+    def decimal_latitude(self):
+        return self.derive("DecimalLatitude", lambda data: dms_to_decimal(data.ISSLatitude))
+
+    def decimal_longitude(self):
+        return self.derive("DecimalLongitude", lambda data: dms_to_decimal(data.ISSLongitude))
+
+    def distance_travelled(self):
+        return self.derive("DistanceTravelled", lambda data: data.DistanceTravelled if "DistanceTravelled" in data
+                           else self.calculate_distance())
+
+    def calculate_distance(self, method="haversine", jobs=0):
+        data = self.load()
+        Distance = distance_travelled(self.decimal_latitude(), self.decimal_longitude(), data.get("ISSElevation"),
+                                      method, self.origin, jobs)
+        self.derived["DistanceTravelled"] = Distance
+        return Distance
+
+
+POINT_BUDGET = 5000
+
+
+def minmax_indices(Values, points=POINT_BUDGET):
+    Values = np.asarray(Values, dtype=float)
+    Length = len(Values)
+    if points <= 0 or Length <= points:
+        return np.arange(Length)
+    BucketSize = -(-Length // max(points // 2, 1))
+    Buckets = -(-Length // BucketSize)
+    Padded = np.pad(Values, (0, Buckets * BucketSize - Length), mode="edge").reshape(Buckets, BucketSize)
+    Offsets = np.arange(Buckets) * BucketSize
+    Minimums = np.argmin(np.where(np.isnan(Padded), np.inf, Padded), axis=1) + Offsets
+    Maximums = np.argmax(np.where(np.isnan(Padded), -np.inf, Padded), axis=1) + Offsets
+    Indices = np.concatenate([Minimums, Maximums, [0, Length - 1]])
+    return np.unique(np.minimum(Indices, Length - 1))
+
+
+def voxel_indices(X, Y, Z, points=POINT_BUDGET, Weights=None):
+    Points = np.column_stack([X, Y, Z]).astype(float)
+    if points <= 0 or len(Points) <= points:
+        return np.arange(len(Points)), Weights
+    Finite = np.flatnonzero(np.isfinite(Points).all(axis=1))
+    if not len(Finite):
+        return Finite, None
+    Points = Points[Finite]
+    Cells = max(int(points ** (1 / 3)), 1)
+    Lowest = Points.min(axis=0)
+    Span = np.where(Points.max(axis=0) > Lowest, Points.max(axis=0) - Lowest, 1)
+    Voxel = np.minimum(((Points - Lowest) / Span * Cells).astype(np.int64), Cells - 1)
+    VoxelId = (Voxel[:, 0] * Cells + Voxel[:, 1]) * Cells + Voxel[:, 2]
+    _, First, Inverse, Counts = np.unique(VoxelId, return_index=True, return_inverse=True, return_counts=True)
+    if Weights is not None:
+        Counts = np.bincount(Inverse.ravel(), weights=np.asarray(Weights, dtype=float)[Finite])
+    return Finite[First], Counts
+
+
+def part_points(dataset, points=POINT_BUDGET):
+    return max(points // dataset.part_count(), 2) if points > 0 else 0
+
+
+def decimated(dataset, columns, Name, points=POINT_BUDGET):
+    Budget = part_points(dataset, points)
+    Pieces = []
+    for Part in dataset.parts():
+        Frame = columns(Part)
+        Pieces.append(Frame.iloc[minmax_indices(Frame[Name], Budget)])
+    return pd.concat(Pieces, ignore_index=True)
+
+
+def plot_field_against_distance(dataset, points=POINT_BUDGET):
+    Points = decimated(dataset, lambda Part: pd.DataFrame({"DistanceTravelled": Part.distance_travelled(),
+                                                           "MagMagnitude": Part.load().MagMagnitude}),
+                       "MagMagnitude", points)
+    fig = plt.figure()
+    plt.plot(Points.DistanceTravelled, Points.MagMagnitude, label="Raw Data")
     plt.xlabel("Distance Travelled / 1000 km")
     plt.ylabel("Magnetic Field Strength / T")
     plt.legend()
-    plt.show()
-    menu(Location)
+    return fig
 
 
-def option2(Longitude, Latitude,Location):
-    Distance = []
-    for i in range(1, len(Longitude)):
-        x = []
-        data = []
-        y = []
-        x = Longitude[i].split(" ")
-        y = Latitude[i].split(" ")
-        z = x[2]
-        z = z[:-1]
-        b = y[2]
-        b = b[:-1]
-        DecimalLongitude = (float(x[0].replace("deg", "")) + float(x[1].replace("'", "")) / 60 + float(z) / (60 * 60))
-        DecimalLatitude = (float(y[0].replace("deg", "")) + float(y[1].replace("'", "")) / 60 + float(b) / (60 * 60))
-        data.append(DecimalLatitude)
-        data.append(DecimalLongitude)
-        with open('Longitude&Latitude.csv', 'a', buffering=1, newline='') as f:
-            data_writer = writer(f)
-            data_writer.writerow(data)
-    menu(Location)
-
-
-def option3(Latitude, Longitude,Location):
+def spline_data(dataset):
     Distance = []
-    for i in range(1, len(Longitude)):
-        Distance.append(Distance[i - 1] + geopy.distance.geodesic((Latitude[i - 1], Longitude[i - 1]),
-                                                                  (Latitude[i], Longitude[i])).km)
-    for i in range(0, len(Distance)):
-        with open("DistanceTravelled", "a", buffering=1, newline=" ") as f:
-            DataWriter = writer(f)
-            DataWriter.writerow(Distance[i])
-    menu(Location)
-
-def option4(Magnetometer,Location):
-    data = pd.read_csv(location)
-    DistanceTravelled = data.DistanceTravelled
-    spl = UnivariateSpline(DistanceTravelled, Magnetometer, k=5)
-    xs = np.linspace(0, 182, 1000)
+    Magnitude = []
+    for Part in dataset.parts():
+        Distance.append(Part.distance_travelled().to_numpy(dtype="float64"))
+        Magnitude.append(Part.load().MagMagnitude.to_numpy(dtype="float64"))
+    return np.concatenate(Distance), np.concatenate(Magnitude)
+
+
+def spline_cache(Output=Path(".")):
+    return Path(Output) / "SplineCache"
+
+
+def fit_spline(dataset, jobs=0, cache_folder=None):
+    Distance, Magnitude = spline_data(dataset)
+    return cached_spline(Distance, Magnitude, cache_folder or spline_cache(), jobs=jobs)
+
+
+def plot_spline(dataset, jobs=0, cache_folder=None):
+    Distance, Magnitude = spline_data(dataset)
+    spl = cached_spline(Distance, Magnitude, cache_folder or spline_cache(), jobs=jobs)
+    xs = evaluation_grid(Distance)
+    fig = plt.figure()
     plt.xlabel("Distance Travelled / 1000 km")
     plt.ylabel("Magnetic Field Strength / T")
     plt.plot(xs, spl(xs), label="Fitted Line")
     plt.legend()
-    plt.show()
-    menu(Location)
+    return fig
+
 
-def option5(Elevation, DateTime,Location):
-    FormattedDateTime = []
-    for i in range(0, len(DateTime)):
-        ParsedDateTime = parser.parse(DateTime)
-        FormattedDateTime.append(ParsedDateTime)
+def plot_elevation_against_time(dataset, points=POINT_BUDGET):
+    Points = decimated(dataset, lambda Part: Part.load()[["DateTime", "ISSElevation"]], "ISSElevation", points)
+    fig = plt.figure()
     plt.xlabel("Time")
     plt.ylabel("Elevation / km")
-    plt.plot(FormattedDateTime, Elevation)
-    plt.show()
-    menu(Location)
+    plt.plot(Points.DateTime, Points.ISSElevation)
+    return fig
 
 
-def option6(DateTime, MagneticFieldStrength,Location):
-    FormattedDateTime = []
-    for i in range(0, len(DateTime)):
-        ParsedDateTime = parser.parse(DateTime)
-        FormattedDateTime.append(ParsedDateTime)
+def plot_field_against_time(dataset, points=POINT_BUDGET):
+    Points = decimated(dataset, lambda Part: Part.load()[["DateTime", "MagMagnitude"]], "MagMagnitude", points)
+    fig = plt.figure()
     plt.xlabel("Time")
     plt.ylabel("Magnetic Field Strength")
-    plt.plot(FormattedDateTime, MagneticFieldStrength)
-    plt.show()
-    menu(Location)
+    plt.plot(Points.DateTime, Points.MagMagnitude)
+    return fig
+
 
-def option7(MagX, MagY, MagZ, Location):
+def plot_field_3d(dataset, points=POINT_BUDGET):
+    Pieces = []
+    Weights = []
+    Counted = False
+    for Part in dataset.parts():
+        data = Part.load()
+        Indices, Counts = voxel_indices(data.MagX, data.MagY, data.MagZ, points)
+        Pieces.append(data[["MagX", "MagY", "MagZ"]].iloc[Indices])
+        Weights.append(np.ones(len(Indices)) if Counts is None else Counts)
+        Counted = Counted or Counts is not None
+    Points = pd.concat(Pieces, ignore_index=True)
+    Indices, Counts = voxel_indices(Points.MagX, Points.MagY, Points.MagZ, points,
+                                    np.concatenate(Weights) if Counted else None)
     fig = plt.figure()
     ax = plt.axes(projection="3d")
-    ax.scatter3D(MagX, MagY, MagZ)
+    if Counts is None:
+        ax.scatter3D(Points.MagX.iloc[Indices], Points.MagY.iloc[Indices], Points.MagZ.iloc[Indices])
+    else:
+        Scatter = ax.scatter3D(Points.MagX.iloc[Indices], Points.MagY.iloc[Indices], Points.MagZ.iloc[Indices],
+                               c=Counts, norm="log")
+        fig.colorbar(Scatter, ax=ax, label="Readings")
     ax.set_xlabel("Magnetometer X")
     ax.set_ylabel("Magnetometer Y")
     ax.set_zlabel("Magnetometer Z")
+    return fig
+
+
+def convert_coordinates(dataset, Output):
+    Messages = []
+    Offset = 0
+    First = True
+    for Part in dataset.parts():
+        data = Part.load()
+        DecimalLatitude = Part.decimal_latitude()
+        DecimalLongitude = Part.decimal_longitude()
+        for Name, Coordinates, Decimal in (("latitude", data.ISSLatitude, DecimalLatitude),
+                                           ("longitude", data.ISSLongitude, DecimalLongitude)):
+            for Row, Coordinate in parse_failures(Coordinates, Decimal).items():
+                Messages.append("Row " + str(Row + Offset) + ": could not convert " + Name + " " + repr(Coordinate))
+        pd.DataFrame({"DecimalLatitude": DecimalLatitude, "DecimalLongitude": DecimalLongitude}).to_csv(
+            Output / "Longitude&Latitude.csv", mode="w" if First else "a", header=First, index=False)
+        Offset = Offset + len(data)
+        First = False
+    return Messages
+
+
+def calculate_distance(dataset, Output, method="haversine", jobs=0):
+    First = True
+    for Part in dataset.parts():
+        Part.calculate_distance(method, jobs).to_frame().to_csv(Output / "DistanceTravelled.csv",
+                                                                mode="w" if First else "a", header=First, index=False)
+        First = False
+
+
+def recalculate_displacement(dataset, Output, scheme="trapezoid"):
+    DateTime = []
+    Accelerations = []
+    for Part in dataset.parts():
+        data = Part.load()
+        DateTime.append(data.DateTime.to_numpy(dtype="datetime64[ns]"))
+        Accelerations.append(np.column_stack([data.AccX, data.AccY, data.AccZ]).astype("float64"))
+    DateTime = pd.Series(np.concatenate(DateTime), name="DateTime")
+    times = (DateTime - DateTime.min()).dt.total_seconds().to_numpy()
+    velocity, displacement = DisplacementIntegrator.integrate(times, np.concatenate(Accelerations), scheme)
+    result = pd.DataFrame({"DateTime": DateTime,
+                           "VelocityX": velocity[:, 0], "VelocityY": velocity[:, 1], "VelocityZ": velocity[:, 2],
+                           "DisplacementX": displacement[:, 0], "DisplacementY": displacement[:, 1],
+                           "DisplacementZ": displacement[:, 2]})
+    result.to_csv(Output / "Displacement.csv", index=False)
+    return result
+
+
+def menu(dataset):
+    while True:
+        dataset.check()
+        os.system("cls" if os.name == "nt" else "clear")
+        print("--------------------------------MENU------------------------------------")
+        print("1) Plot graph of raw magnetic field strength against distance travelled")
+        print("2) Format longitude and latitude from degrees to decimal")
+        print("3) Get distance travelled of the ISS from longitude and latitude")
+        print("4) Create univariate interpolated spline of raw data and plot graph")
+        print("5) Plot graph of elevation against time")
+        print("6) Plot magnetic field strength against time")
+        print("7) Plot magnetic field strength in 3D")
+        print("8) Recalculate displacement from the accelerometer readings")
+        print("9) End program")
+        UserChoice = input("Enter your choice: ")
+        if UserChoice == "9":
+            return
+        try:
+            if UserChoice == "1":
+                option1(dataset)
+            elif UserChoice == "2":
+                option2(dataset)
+            elif UserChoice == "3":
+                option3(dataset)
+            elif UserChoice == "4":
+                option4(dataset)
+            elif UserChoice == "5":
+                option5(dataset)
+            elif UserChoice == "6":
+                option6(dataset)
+            elif UserChoice == "7":
+                option7(dataset)
+            elif UserChoice == "8":
+                option8(dataset)
+        except Exception as e:
+            print(f'{e.__class__.__name__}: {e}')
+            input("Press enter to return to the menu")
+
+
+def option1(dataset):
+    plot_field_against_distance(dataset)
+    plt.show()
+
+
+def option2(dataset):
+    for Message in convert_coordinates(dataset, Path(".")):
+        print(Message)
+    input("Press enter to return to the menu")
+
+
+def option3(dataset):
+    method = input("Enter distance method (" + ", ".join(DISTANCE_METHODS) + "): ") or "haversine"
+    calculate_distance(dataset, Path("."), method)
+
+
+def option4(dataset):
+    plot_spline(dataset)
+    plt.show()
+
+
+def option5(dataset):
+    plot_elevation_against_time(dataset)
+    plt.show()
+
+
+def option6(dataset):
+    plot_field_against_time(dataset)
     plt.show()
-    menu(Location)
 
-location = input("Enter location of csv file: ")
-menu(location)
+
+def option7(dataset):
+    plot_field_3d(dataset)
+    plt.show()
+
+
+def option8(dataset):
+    scheme = input("Enter integration scheme (" + ", ".join(SCHEMES) + "): ") or "trapezoid"
+    recalculate_displacement(dataset, Path("."), scheme)
+
+
+PLOTS = {"MagneticFieldAgainstDistance": plot_field_against_distance,
+         "ElevationAgainstTime": plot_elevation_against_time,
+         "MagneticFieldAgainstTime": plot_field_against_time,
+         "MagneticField3D": plot_field_3d}
+
+
+def save_figure(fig, Output, name, arguments):
+    fig.savefig(Output / (name + "." + arguments.format))
+    plt.close(fig)
+
+
+def step_coordinates(dataset, Output, arguments):
+    return convert_coordinates(dataset, Output)
+
+
+def step_distance(dataset, Output, arguments):
+    calculate_distance(dataset, Output, arguments.distance_method, arguments.file_jobs)
+
+
+def step_displacement(dataset, Output, arguments):
+    recalculate_displacement(dataset, Output, arguments.scheme)
+
+
+def step_spline(dataset, Output, arguments):
+    save_figure(plot_spline(dataset, arguments.file_jobs, spline_cache(arguments.output)), Output, "Spline", arguments)
+
+
+def step_plots(dataset, Output, arguments):
+    for name, plot in PLOTS.items():
+        save_figure(plot(dataset, arguments.points), Output, name, arguments)
+
+
+def segment_status(Segment, Entry, Part):
+    Problem = segment_problem(Segment)
+    if Problem is not None:
+        return Problem, None
+    try:
+        data = Part.load()
+    except (OSError, ValueError) as e:
+        return f'{e.__class__.__name__}: {e}', None
+    if Entry is None:
+        return "not indexed", data
+    if file_checksum(Segment) != Entry.get("sha256"):
+        return "checksum mismatch", data
+    if len(data) != Entry.get("rows"):
+        return "row count mismatch", data
+    return "recovered" if Entry.get("recovered") else "ok", data
+
+
+def step_segments(dataset, Output, arguments):
+    if not os.path.isdir(dataset.location):
+        return ["segments skipped: " + dataset.location + " is not a folder of segments"]
+    Messages = []
+    Rows = []
+    for Segment, Entry in segment_index(dataset.location):
+        Status, data = segment_status(Segment, Entry, dataset.segment(Segment))
+        if Status not in ("ok", "recovered"):
+            Messages.append(Segment.name + ": " + Status)
+        Row = {"Segment": Segment.name, "Status": Status, "Rows": 0 if data is None else len(data)}
+        if data is not None:
+            Row.update({"Start": data.DateTime.min(), "End": data.DateTime.max(),
+                        "MagMagnitudeMean": data.MagMagnitude.mean(), "MagMagnitudeMin": data.MagMagnitude.min(),
+                        "MagMagnitudeMax": data.MagMagnitude.max()})
+        Rows.append(Row)
+    pd.DataFrame(Rows).to_csv(Output / "Segments.csv", index=False)
+    return Messages
+
+
+STEPS = {"coordinates": step_coordinates, "distance": step_distance, "displacement": step_displacement,
+         "spline": step_spline, "plots": step_plots, "segments": step_segments}
+
+
+def run_ids(locations):
+    Locations = [Path(location).resolve() for location in locations]
+    if not Locations:
+        return []
+    Common = Path(os.path.commonpath([Location.parent for Location in Locations]))
+    RunIds = [Location.relative_to(Common).with_suffix("").as_posix() for Location in Locations]
+    Sources = {}
+    for RunId, Location in zip(RunIds, Locations):
+        Sources.setdefault(RunId, set()).add(Location)
+    RunIds = [RunId + "_" + Location.suffix.lstrip(".") if len(Sources[RunId]) > 1 and Location.suffix else RunId
+              for RunId, Location in zip(RunIds, Locations)]
+    Seen = {}
+    UniqueIds = []
+    for RunId in RunIds:
+        Seen[RunId] = Seen.get(RunId, 0) + 1
+        UniqueIds.append(RunId if Seen[RunId] == 1 else RunId + "-" + str(Seen[RunId]))
+    return UniqueIds
+
+
+def summarise_run(dataset, RunId, cache_folder=None):
+    Tables = []
+    for Part in dataset.parts():
+        Table = Part.load().copy()
+        Table["DecimalLatitude"] = Part.decimal_latitude()
+        Table["DecimalLongitude"] = Part.decimal_longitude()
+        Table["DistanceTravelled"] = Part.distance_travelled()
+        Tables.append(Table)
+    Table = pd.concat(Tables, ignore_index=True)
+    Table.insert(0, "RunId", RunId)
+    try:
+        SplineResidual = fit_spline(dataset, 1, cache_folder).residual(Table.DistanceTravelled, Table.MagMagnitude)
+    except Exception:
+        SplineResidual = np.nan
+    Summary = {"RunId": RunId, "Location": dataset.location, "Rows": len(Table),
+               "Start": Table.DateTime.min(), "End": Table.DateTime.max(),
+               "DurationSeconds": (Table.DateTime.max() - Table.DateTime.min()).total_seconds(),
+               "DistanceTravelled": Table.DistanceTravelled.max(),
+               "CoordinateFailures": int(Table.DecimalLatitude.isna().sum() + Table.DecimalLongitude.isna().sum()),
+               "MagMagnitudeMean": Table.MagMagnitude.mean(), "MagMagnitudeStd": Table.MagMagnitude.std(),
+               "MagMagnitudeMin": Table.MagMagnitude.min(), "MagMagnitudeMax": Table.MagMagnitude.max(),
+               "ISSElevationMean": Table.ISSElevation.mean(), "SplineResidual": SplineResidual}
+    return Table, Summary
+
+
+def run_file(location, RunId, arguments):
+    plt.switch_backend("Agg")
+    step = "load"
+    Messages = []
+    try:
+        if location.endswith(".bin"):
+            location = convert_binary(location)
+        dataset = Dataset(location)
+        dataset.check()
+        Output = Path(arguments.output) / RunId
+        Output.mkdir(parents=True, exist_ok=True)
+        for step in arguments.steps:
+            Messages.extend(STEPS[step](dataset, Output, arguments) or [])
+        Table = None
+        Summary = None
+        if arguments.combine:
+            step = "summary"
+            Table, Summary = summarise_run(dataset, RunId, spline_cache(arguments.output))
+        Messages.extend(dataset.problems)
+        return location, True, Messages, Table, Summary
+    except Exception as e:
+        Messages.append(step + " failed: " + f'{e.__class__.__name__}: {e}')
+        return location, False, Messages, None, None
+
+
+def run_steps(locations, arguments):
+    RunIds = run_ids(locations)
+    arguments.file_jobs = arguments.jobs
+    if arguments.jobs == 1 or len(locations) == 1:
+        Results = [run_file(location, RunId, arguments) for location, RunId in zip(locations, RunIds)]
+    else:
+        arguments.file_jobs = 1
+        with ProcessPoolExecutor(max_workers=arguments.jobs or None) as executor:
+            Results = list(executor.map(run_file, locations, RunIds, [arguments] * len(locations)))
+    ExitCode = 0
+    Tables = []
+    Summaries = []
+    for location, Succeeded, Messages, Table, Summary in Results:
+        for Message in Messages:
+            print(location + ": " + Message, file=sys.stderr)
+        if Succeeded:
+            print(location + ": done")
+        else:
+            ExitCode = 1
+        if Table is not None:
+            Tables.append(Table)
+            Summaries.append(Summary)
+    if arguments.combine and Tables:
+        Output = Path(arguments.output)
+        Output.mkdir(parents=True, exist_ok=True)
+        pd.concat(Tables, ignore_index=True).to_csv(Output / "Combined.csv", index=False)
+        pd.DataFrame(Summaries).to_csv(Output / "Summary.csv", index=False)
+    return ExitCode
+
+
+def parse_arguments(argv=None):
+    ArgumentParser = argparse.ArgumentParser(
+        description="Analyse the data recorded by main.py. With no files the interactive menu is started.")
+    ArgumentParser.add_argument("locations", nargs="*",
+                                help="csv or bin files, or folders of segments recorded by main.py, to analyse")
+    ArgumentParser.add_argument("--steps", default="coordinates,distance,spline,plots",
+                                help="comma separated steps to run, from " + ", ".join(STEPS))
+    ArgumentParser.add_argument("--output", default="output",
+                                help="folder the results are written to, in a sub folder for each run")
+    ArgumentParser.add_argument("--format", default="png", choices=["png", "svg"], help="format of the plots")
+    ArgumentParser.add_argument("--points", type=int, default=POINT_BUDGET,
+                                help="most points drawn for each series of a plot, 0 draws every reading")
+    ArgumentParser.add_argument("--distance-method", default="haversine", choices=DISTANCE_METHODS)
+    ArgumentParser.add_argument("--scheme", default="trapezoid", choices=SCHEMES,
+                                help="integration scheme of the displacement step")
+    ArgumentParser.add_argument("--jobs", type=int, default=0,
+                                help="number of files analysed at the same time, or of spline windows and geodesic "
+                                     "distances worked out at the same time for a single file, 0 uses every core")
+    ArgumentParser.add_argument("--combine", action="store_true",
+                                help="also write Combined.csv with every run and a RunId column, and Summary.csv with "
+                                     "summary statistics of every run")
+    arguments = ArgumentParser.parse_args(argv)
+    arguments.steps = [step.strip() for step in arguments.steps.split(",") if step.strip()]
+    for step in arguments.steps:
+        if step not in STEPS:
+            ArgumentParser.error("unknown step " + repr(step) + ", expected one of " + ", ".join(STEPS))
+    return arguments
+
+
+def read_binary(location):
+    with open(location, "rb") as f:
+        header = f.readline().decode()
+    if not header.startswith("HHBIN "):
+        raise ValueError(location + " is not a binary recording from main.py")
+    schema = json.loads(header[len("HHBIN "):])
+    dtype = np.dtype([(name, "<i8" if kind == "int64" else "<f8") for name, kind, unit in schema["columns"]])
+    count = (os.path.getsize(location) - schema["header_size"]) // dtype.itemsize
+    if count <= 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(location, dtype=dtype, mode="r", offset=schema["header_size"], shape=(count,))
+
+
+def format_degrees(degrees):
+    if degrees != degrees:
+        return ""
+    tenths = round(abs(degrees) * 36000)
+    sign = "-" if degrees < 0 else ""
+    return '{0}{1:02}deg {2:02}\' {3:02}.{4}"'.format(sign, tenths // 36000, tenths // 600 % 60, tenths // 10 % 60,
+                                                     tenths % 10)
+
+
+def convert_binary(location, chunk_size=100000):
+    records = read_binary(location)
+    names = records.dtype.names
+    CsvLocation = os.path.splitext(location)[0] + ".csv"
+    with open(CsvLocation, "w", newline="") as f:
+        DataWriter = writer(f)
+        DataWriter.writerow(names)
+        for start in range(0, len(records), chunk_size):
+            chunk = records[start:start + chunk_size]
+            DateTime = chunk[names[0]].astype("datetime64[ns]").astype("datetime64[us]")
+            columns = [[str(t).replace("T", " ") for t in DateTime]]
+            for name in names[1:]:
+                values = chunk[name].tolist()
+                if name in ("ISS Latitude", "ISS Longitude"):
+                    columns.append([format_degrees(value) for value in values])
+                else:
+                    columns.append(["" if value != value else value for value in values])
+            DataWriter.writerows(zip(*columns))
+    return CsvLocation
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    if not arguments.locations:
+        location = input("Enter location of csv or bin file, or folder of segments: ")
+        if location.endswith(".bin"):
+            location = convert_binary(location)
+        menu(Dataset(location))
+        return 0
+    plt.switch_backend("Agg")
+    return run_steps(arguments.locations, arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# -------------------------------
+# HHORIZONS DISPLACEMENT INTEGRATOR
+# -------------------------------
+
+# This file holds the maths we use to work out the displacement of the AstroPi from the accelerometer readings. It is
+# used by main.py to work out the displacement one reading at a time while the readings are being taken, and by
+# DataAnalysis.py to work out the displacement again from a whole recorded data file at once.
+
+# -------------------------------
+# IMPORTS
+# -------------------------------
+
+import numpy as np  # Allows us to work out the displacement for a whole data file at once
+
+# -------------------------------
+# DISPLACEMENT INTEGRATOR
+# -------------------------------
+
+# The names of the ways the integrate method can work out the displacement
+# 'flight' is the formula which main.py uses while the readings are being taken
+# 'trapezoid' works out the velocity and then the displacement with the trapezium rule
+# 'simpson' works out the velocity and then the displacement with Simpson's rule, using a curve through each reading
+# and the ones either side of it, which also works when the readings are not evenly spaced
+# 'drift-corrected' takes away the average acceleration of each axis, which is the bias of the accelerometer, before
+# using the trapezium rule, and takes away the straight line which best fits the velocity, so the error in the
+# velocity does not keep growing the displacement
+SCHEMES = ['flight', 'trapezoid', 'simpson', 'drift-corrected']
+
+
+# This class works out the displacement of the AstroPi between accelerometer readings. The update method is given one
+# reading at a time, with the x,y,z accelerations and the time it was taken, and returns the x,y,z displacement since
+# the previous reading. It keeps the state it needs as three value lists:
+# acceleration is the previous acceleration and previous_acceleration is the acceleration from two readings ago
+# velocity is the instantaneous velocity at the reading before the previous one
+# time is the time of the previous reading and previous_time is the time of the reading from two readings ago
+# We use our displacement formula to calculate initially the previous velocity of the AstroPi. Then using the
+# calculated velocity and other data it will calculate the displacement of the AstroPi for that reading. The first
+# two readings only fill the state, so update returns None for them.
+
+class DisplacementIntegrator:
+    def __init__(self):
+        self.acceleration = None
+        self.previous_acceleration = None
+        self.velocity = [0.0, 0.0, 0.0]
+        self.time = None
+        self.previous_time = None
+
+    def update(self, acceleration, time):
+        displacement = None
+        if self.previous_time is not None:
+            interval = self.time - self.previous_time
+            next_interval = time - self.time
+            velocity = [0.5 * (a1 + a2) * interval + v2 for a1, a2, v2 in
+                        zip(self.acceleration, self.previous_acceleration, self.velocity)]
+            displacement = [0.25 * (a + a1) * next_interval + v1 * next_interval for a, a1, v1 in
+                            zip(acceleration, self.acceleration, velocity)]
+            self.velocity = velocity
+        self.previous_acceleration = self.acceleration
+        self.acceleration = list(acceleration)
+        self.previous_time = self.time
+        self.time = time
+        return displacement
+
+    # Works out the velocity and displacement for a whole series of readings at once. times is a list of the times of
+    # the readings in seconds and accelerations is a list of the x,y,z accelerations. It returns the velocity at every
+    # reading and the displacement since the reading before it, which is 0 for the first reading. A reading with a
+    # missing time or acceleration, or with a time which is not after the time of the readings before it, is left out,
+    # so it can not make the velocity of every reading after it NaN, and its velocity and displacement are NaN.
+    @staticmethod
+    def integrate(times, accelerations, scheme='trapezoid'):
+        if scheme not in SCHEMES:
+            raise ValueError('Unknown scheme ' + repr(scheme) + ', expected one of ' + ', '.join(SCHEMES))
+        times = np.asarray(times, dtype=float)
+        accelerations = np.asarray(accelerations, dtype=float).reshape(len(times), 3)
+        valid = valid_readings(times, accelerations)
+        if valid.all():
+            return integrate_readings(times, accelerations, scheme)
+        velocity = np.full_like(accelerations, np.nan)
+        displacement = np.full_like(accelerations, np.nan)
+        velocity[valid], displacement[valid] = integrate_readings(times[valid], accelerations[valid], scheme)
+        return velocity, displacement
+
+
+# Returns which readings have a time and every acceleration, and a time after the times of every reading before them
+def valid_readings(times, accelerations):
+    valid = np.isfinite(times) & np.isfinite(accelerations).all(axis=1)
+    indices = np.flatnonzero(valid)
+    if len(indices) > 1:
+        latest = np.maximum.accumulate(times[indices])
+        valid[indices[1:]] = times[indices[1:]] > latest[:-1]
+    return valid
+
+
+# Works out the velocity and displacement of integrate for readings which are all valid
+def integrate_readings(times, accelerations, scheme):
+    velocity = np.zeros_like(accelerations)
+    displacement = np.zeros_like(accelerations)
+    if len(times) < 2:
+        return velocity, displacement
+    intervals = np.diff(times)[:, None]
+
+    if scheme == 'flight':
+        velocity[1:] = np.cumsum(trapezoid_intervals(accelerations, intervals), axis=0)
+        displacement[1:] = (0.25 * (accelerations[1:] + accelerations[:-1]) * intervals +
+                            velocity[:-1] * intervals)
+        return velocity, displacement
+
+    if scheme == 'simpson':
+        integrate_intervals = simpson_intervals
+    else:
+        integrate_intervals = trapezoid_intervals
+    if scheme == 'drift-corrected':
+        accelerations = accelerations - accelerations.mean(axis=0)
+    velocity[1:] = np.cumsum(integrate_intervals(accelerations, intervals), axis=0)
+    if scheme == 'drift-corrected':
+        velocity = velocity - linear_trend(times, velocity)
+    displacement[1:] = integrate_intervals(velocity, intervals)
+    return velocity, displacement
+
+
+# Returns the area under each interval between readings using the trapezium rule
+def trapezoid_intervals(values, intervals):
+    return 0.5 * (values[1:] + values[:-1]) * intervals
+
+
+# Returns the area under each interval between readings using a curve through three readings, the two at the ends of
+# the interval and the one after it, or the one before it for the last interval. The weights are the exact area under
+# that curve, so the readings do not have to be evenly spaced. With fewer than three readings the trapezium rule is
+# used instead.
+def simpson_intervals(values, intervals):
+    if len(values) < 3:
+        return trapezoid_intervals(values, intervals)
+    areas = np.empty_like(values[1:])
+    h0 = intervals[:-1]
+    h1 = intervals[1:]
+    total = h0 + h1
+    areas[:-1] = ((h0 / 2 - h0 ** 2 / (6 * total)) * values[:-2] + (total * h0 / 2 - h0 ** 2 / 3) / h1 * values[1:-1]
+                  - h0 ** 3 / (6 * total * h1) * values[2:])
+    h0 = intervals[-1]
+    h1 = intervals[-2]
+    total = h0 + h1
+    areas[-1] = ((h0 / 2 - h0 ** 2 / (6 * total)) * values[-1] + (total * h0 / 2 - h0 ** 2 / 3) / h1 * values[-2]
+                 - h0 ** 3 / (6 * total * h1) * values[-3])
+    return areas
+
+
+# Returns the straight line in time which best fits each column of values
+def linear_trend(times, values):
+    design = np.column_stack([np.ones_like(times), times - times[0]])
+    coefficients = np.linalg.lstsq(design, values, rcond=None)[0]
+    return design @ coefficients
@@ -0,0 +1,308 @@
+# -------------------------------
+# HHORIZONS SENSOR BACKENDS
+# -------------------------------
+
+# This file holds the backends main.py can take its readings from. On the Astro Pi the readings come from the sense
+# hat and the orbit library, but those are only available on the Astro Pi, so there are also two backends which work
+# on any computer: a synthetic backend which makes up readings, and a replay backend which plays back a data.csv file
+# recorded by main.py. Every backend gives main.py a sense object with the sense hat methods main.py uses and an iss
+# object with a coordinates method which returns the position of the ISS like the orbit library does, so the rest of
+# main.py does not need to know which backend it is using. This lets us measure how fast main.py can take, work out
+# and write the readings without an Astro Pi.
+
+# -------------------------------
+# IMPORTS
+# -------------------------------
+
+import csv  # Allows us to read the recorded data file in the replay backend
+import math  # Allows us to work out the synthetic readings and the position of the ISS
+import random  # Allows us to add noise to the synthetic readings
+import threading  # Allows the sensor readings and the ISS position to be read from different threads
+import time  # Allows us to work out how far through the recording the replay backend is
+from datetime import datetime  # Allows us to read the times in the recorded data file
+from pathlib import Path  # Allows us to find the segments in a data folder recorded by main.py
+
+# -------------------------------
+# SETTINGS
+# -------------------------------
+
+# The names of the backends create_backend can make
+# 'astropi' uses the sense hat and the orbit library, and only works on the Astro Pi
+# 'synthetic' makes up readings and an ISS position from a simple circular orbit
+# 'replay' plays back a data.csv file recorded by main.py
+BACKENDS = ['astropi', 'synthetic', 'replay']
+
+# The orbit the synthetic backend uses, which is close to the real orbit of the ISS
+ORBIT_INCLINATION = 51.64
+ORBIT_PERIOD = 92.68 * 60
+ORBIT_ELEVATION = 420.0
+EARTH_ROTATION_PERIOD = 86164.1
+
+# -------------------------------
+# POSITION
+# -------------------------------
+
+# These classes hold a position in the same way as the position returned by the orbit library, so main.py can use
+# latitude.degrees, longitude.degrees and elevation.km, and writing a latitude or longitude to data.csv gives the same
+# degrees, minutes and seconds text as the orbit library does.
+
+class Angle:
+    def __init__(self, degrees, text=None):
+        self.degrees = degrees
+        self.text = text
+
+    def __str__(self):
+        if self.text is not None:
+            return self.text
+        tenths = round(abs(self.degrees) * 36000)
+        sign = '-' if self.degrees < 0 else ''
+        return '{0}{1:02}deg {2:02}\' {3:02}.{4}"'.format(sign, tenths // 36000, tenths // 600 % 60,
+                                                         tenths // 10 % 60, tenths % 10)
+
+
+class Distance:
+    def __init__(self, km):
+        self.km = km
+
+
+class Position:
+    def __init__(self, latitude, longitude, elevation):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.elevation = elevation
+
+
+# Turns a latitude or longitude written by main.py, such as 51deg 30' 12.3", back into an Angle
+def parse_angle(text):
+    parts = text.replace('deg', ' ').replace("'", ' ').replace('"', ' ').split()
+    degrees = abs(float(parts[0])) + float(parts[1]) / 60 + float(parts[2]) / 3600
+    if text.strip().startswith('-'):
+        degrees = -degrees
+    return Angle(degrees, text)
+
+# -------------------------------
+# SYNTHETIC BACKEND
+# -------------------------------
+
+# This class makes up sense hat readings. The magnetometer readings follow a field which changes slowly as the ISS
+# goes round its orbit, and the accelerometer readings are the small accelerations of free fall, both with random
+# noise added. The LED matrix methods do nothing. seed can be given so the same readings are made every time.
+
+class SyntheticSenseHat:
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def set_rotation(self, rotation):
+        pass
+
+    def show_message(self, message):
+        pass
+
+    def set_pixel(self, x, y, r, g, b):
+        pass
+
+    def clear(self):
+        pass
+
+    def get_compass_raw(self):
+        phase = 2 * math.pi * (time.monotonic() - self.start) / ORBIT_PERIOD
+        with self.lock:
+            return {'x': 20 * math.sin(phase) + self.random.gauss(0, 0.5),
+                    'y': 15 * math.cos(phase) + self.random.gauss(0, 0.5),
+                    'z': -30 + 10 * math.sin(2 * phase) + self.random.gauss(0, 0.5)}
+
+    def get_accelerometer_raw(self):
+        with self.lock:
+            return {'x': self.random.gauss(0, 0.01), 'y': self.random.gauss(0, 0.01),
+                    'z': self.random.gauss(0, 0.01)}
+
+
+# This class works out the position of the ISS on a circular orbit at ORBIT_INCLINATION degrees, taking
+# ORBIT_PERIOD seconds to go round, with the Earth turning underneath it.
+
+class SyntheticISS:
+    def __init__(self):
+        self.start = time.time()
+
+    def coordinates(self):
+        elapsed = time.time() - self.start
+        phase = 2 * math.pi * elapsed / ORBIT_PERIOD
+        inclination = math.radians(ORBIT_INCLINATION)
+        latitude = math.degrees(math.asin(math.sin(inclination) * math.sin(phase)))
+        longitude = math.degrees(math.atan2(math.cos(inclination) * math.sin(phase), math.cos(phase)))
+        longitude = (longitude - 360 * elapsed / EARTH_ROTATION_PERIOD + 180) % 360 - 180
+        return Position(Angle(latitude), Angle(longitude), Distance(ORBIT_ELEVATION + 5 * math.sin(phase)))
+
+# -------------------------------
+# REPLAY BACKEND
+# -------------------------------
+
+# This class plays back a data.csv file recorded by main.py, or every csv segment in a data folder recorded by main.py
+# one after another in the order they were recorded. The file is read one row at a time as it is needed, so a long
+# recording is never held in memory all at once. speed is how many times faster than it was recorded the file is
+# played back, so the row returned is the last one recorded before that much time has passed since the replay started. A
+# speed of 0 plays the file back as fast as it is read, moving on by one row for every accelerometer reading, which is
+# also used if the times in the file can not be read. When the end of the file is reached it starts again from the
+# beginning. Readings which are missing from a row raise an OSError, in the same way as a sense hat reading which fails.
+# The same object is used as the sense and the iss of main.py, so the readings and the position come from the same row.
+
+class Replay:
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.paths = replay_files(path)
+        self.part = 0
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.file = None
+        self.reader = None
+        self.row = None
+        self.next_row = None
+        self.first_time = None
+        self.fast = speed <= 0
+        self.start = None
+        self.loops = 0
+        self.rows = 0
+        self.open()
+
+    def open(self):
+        self.part = 0
+        self.open_part()
+        self.next_row = self.read_row()
+        if self.next_row is None:
+            raise ValueError(str(self.path) + ' has no rows to replay')
+        self.first_time = self.row_time(self.next_row)
+        self.fast = self.speed <= 0 or self.first_time is None
+        self.start = time.monotonic()
+        self.row = None
+
+    # Opens the file of the current part of the recording and skips its header
+    def open_part(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.paths[self.part], newline='')
+        self.reader = csv.reader(self.file)
+        next(self.reader, None)
+
+    # Returns the next row of the recording, moving on to the next segment at the end of each one, or None at the end
+    # of the last one
+    def read_row(self):
+        while True:
+            for row in self.reader:
+                if row:
+                    return row
+            if self.part + 1 >= len(self.paths):
+                return None
+            self.part = self.part + 1
+            self.open_part()
+
+    @staticmethod
+    def row_time(row):
+        try:
+            return datetime.fromisoformat(row[0]).timestamp()
+        except (ValueError, IndexError):
+            return None
+
+    # Moves on to the next row, reading the file from the beginning again once it reaches the end
+    def take_row(self):
+        if self.next_row is None:
+            self.loops = self.loops + 1
+            self.open()
+        self.row = self.next_row
+        self.rows = self.rows + 1
+        self.next_row = self.read_row()
+
+    # Moves on by one row if step is True, otherwise moves on to the last row recorded before the current replay time
+    def advance(self, step=False):
+        if self.row is None or step:
+            self.take_row()
+            if step or self.fast:
+                return
+        if self.fast:
+            return
+        due = self.first_time + (time.monotonic() - self.start) * self.speed
+        while True:
+            if self.next_row is None:
+                self.take_row()
+                return
+            next_time = self.row_time(self.next_row)
+            if next_time is None or next_time > due:
+                return
+            self.take_row()
+
+    def current(self, step=False):
+        with self.lock:
+            self.advance(step)
+            return self.row
+
+    def values(self, row, columns, name):
+        try:
+            return {axis: float(row[column]) for axis, column in columns.items()}
+        except (ValueError, IndexError):
+            raise OSError('No ' + name + ' reading in row ' + str(self.rows) + ' of the recording') from None
+
+    def set_rotation(self, rotation):
+        pass
+
+    def show_message(self, message):
+        pass
+
+    def set_pixel(self, x, y, r, g, b):
+        pass
+
+    def clear(self):
+        pass
+
+    def get_compass_raw(self):
+        with self.lock:
+            row = self.row
+        if row is None:
+            row = self.current()
+        return self.values(row, {'x': 1, 'y': 2, 'z': 3}, 'magnetometer')
+
+    def get_accelerometer_raw(self):
+        return self.values(self.current(step=self.fast), {'x': 5, 'y': 6, 'z': 7}, 'accelerometer')
+
+    def coordinates(self):
+        with self.lock:
+            row = self.row
+        if row is None:
+            row = self.current()
+        try:
+            return Position(parse_angle(row[11]), parse_angle(row[12]), Distance(float(row[13])))
+        except (ValueError, IndexError):
+            raise OSError('No ISS position in row ' + str(self.rows) + ' of the recording') from None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+# Returns the files the replay backend plays back from path, which is path itself if it is a file, or every csv
+# segment in it in the order they were recorded if it is a data folder recorded by main.py
+def replay_files(path):
+    path = Path(path)
+    if not path.is_dir():
+        return [path]
+    paths = sorted(path.glob('data-*.csv'))
+    if not paths:
+        raise ValueError(str(path) + ' has no csv segments to replay')
+    return paths
+
+# -------------------------------
+# CREATING A BACKEND
+# -------------------------------
+
+# Returns the sense and iss objects of the backend called name. The sense hat and orbit libraries are only imported
+# when the 'astropi' backend is used, so main.py can be imported and run on a computer which does not have them.
+def create_backend(name='astropi', replay_file=None, speed=1.0, seed=None):
+    if name == 'astropi':
+        from sense_hat import SenseHat
+        from orbit import ISS
+        return SenseHat(), ISS
+    if name == 'synthetic':
+        return SyntheticSenseHat(seed), SyntheticISS()
+    if name == 'replay':
+        replay = Replay(replay_file, speed)
+        return replay, replay
+    raise ValueError('Unknown backend ' + repr(name) + ', expected one of ' + ', '.join(BACKENDS))
@@ -0,0 +1,189 @@
+# -------------------------------
+# HHORIZONS SPLINE FITTING
+# -------------------------------
+
+# This file holds the smoothing spline we fit through the magnetic field strength against the distance travelled. A
+# single spline over a whole long run is slow to fit and fails when the same distance appears more than once, so the
+# readings are sorted, readings at the same distance are averaged, and the run is split into overlapping windows which
+# each get their own spline. The windows can be fitted at the same time in separate processes, and the fitted splines
+# are saved to a cache folder, so drawing the same plot again does not fit the splines again.
+
+# -------------------------------
+# IMPORTS
+# -------------------------------
+
+import hashlib  # Allows us to name the cache file after the readings the splines were fitted to
+import json  # Allows us to add the settings of the fit to the name of the cache file
+from concurrent.futures import ProcessPoolExecutor  # Allows us to fit the windows at the same time
+from pathlib import Path  # Allows us to find the cache file
+import numpy as np  # Allows us to sort, average and split the readings
+from scipy.interpolate import splrep, splev  # Allows us to fit and evaluate each spline
+
+# -------------------------------
+# SETTINGS
+# -------------------------------
+
+# SPLINE_DEGREE is the degree of each spline, which is the degree the analysis has always used
+# WINDOW_POINTS is the most distinct distances each spline is fitted to, apart from the overlap
+# OVERLAP_POINTS is how many distances each window also fits on either side, so neighbouring splines agree where they
+# meet and can be blended together
+# SMOOTHING is multiplied by the number of distances in a window to give the smoothing factor of its spline, 1 gives
+# the same smoothing as UnivariateSpline uses by default
+# CACHE_VERSION is added to the name of every cache file, and should be changed if the fitting below is changed
+SPLINE_DEGREE = 5
+WINDOW_POINTS = 20000
+OVERLAP_POINTS = 2000
+SMOOTHING = 1.0
+CACHE_VERSION = 1
+
+# -------------------------------
+# PREPARING THE READINGS
+# -------------------------------
+
+# Removes readings which are not numbers, sorts the rest by x and averages the readings which have the same x. It
+# returns the distinct x values, the average y at each of them and the weight of each average, which is the square
+# root of how many readings were averaged, because an average of n readings has an error sqrt(n) times smaller.
+def prepare(x, y):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    x = x[finite]
+    y = y[finite]
+    order = np.argsort(x, kind='stable')
+    x = x[order]
+    y = y[order]
+    distinct, first, counts = np.unique(x, return_index=True, return_counts=True)
+    averages = np.add.reduceat(y, first) / counts if len(x) else y
+    return distinct, averages, np.sqrt(counts)
+
+
+# Returns an evenly spaced grid of x values which covers the readings, to draw the splines on
+def evaluation_grid(x, points=1000):
+    x = np.asarray(x, dtype=float)
+    x = x[np.isfinite(x)]
+    if not len(x):
+        return x
+    return np.linspace(x.min(), x.max(), points)
+
+# -------------------------------
+# WINDOWED SPLINE
+# -------------------------------
+
+# Fits one spline to the readings of one window and returns its knots, coefficients and degree
+def fit_window(x, y, weights, degree, smoothing):
+    knots, coefficients, degree = splrep(x, y, w=weights, k=degree, s=smoothing * len(x))
+    return knots, coefficients, degree
+
+
+# This class holds the splines of every window. Each window has a core, the readings it is responsible for, and is
+# fitted to its core and the overlap on either side of it. Where two windows overlap, their splines are blended with
+# weights which go down in a straight line from 1 at the edge of the core to 0 at the edge of the fit, so the result
+# has no jumps. Outside the readings the first and last splines are used. bounds holds the start and end of the core
+# and the start and end of the fit of every window, and splines holds the knots, coefficients and degree of every
+# window.
+
+class WindowedSpline:
+    def __init__(self, bounds, splines):
+        self.bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        self.splines = splines
+
+    # Fits the splines to the readings. jobs is the number of processes the windows are fitted in, 0 uses every core
+    # and 1 fits them one after another in this process.
+    @classmethod
+    def fit(cls, x, y, degree=SPLINE_DEGREE, window=WINDOW_POINTS, overlap=OVERLAP_POINTS, smoothing=SMOOTHING,
+            jobs=0):
+        x, y, weights = prepare(x, y)
+        if len(x) < 2:
+            raise ValueError('At least 2 distinct x values are needed to fit a spline, got ' + str(len(x)))
+        degree = min(degree, len(x) - 1)
+        overlap = max(overlap, degree + 1)
+        count = -(-len(x) // max(window, degree + 1))
+        edges = np.linspace(0, len(x), count + 1).astype(int)
+        bounds = []
+        windows = []
+        for start, end in zip(edges[:-1], edges[1:]):
+            fit_start = max(start - overlap, 0)
+            fit_end = min(end + overlap, len(x))
+            bounds.append([x[start], x[end - 1], x[fit_start], x[fit_end - 1]])
+            windows.append((x[fit_start:fit_end], y[fit_start:fit_end], weights[fit_start:fit_end], degree,
+                            smoothing))
+        if jobs == 1 or len(windows) == 1:
+            splines = [fit_window(*arguments) for arguments in windows]
+        else:
+            with ProcessPoolExecutor(max_workers=jobs or None) as executor:
+                splines = list(executor.map(fit_window, *zip(*windows)))
+        return cls(bounds, splines)
+
+    # Returns the blending weight of window number index at each of the x values
+    def weights(self, index, x):
+        core_start, core_end, fit_start, fit_end = self.bounds[index]
+        weights = np.ones_like(x)
+        if index > 0:
+            weights = np.minimum(weights, np.clip((x - fit_start) / max(core_start - fit_start, 1e-300), 0, 1))
+        if index < len(self.bounds) - 1:
+            weights = np.minimum(weights, np.clip((fit_end - x) / max(fit_end - core_end, 1e-300), 0, 1))
+        return weights
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=float)
+        values = np.zeros_like(x)
+        totals = np.zeros_like(x)
+        for index, spline in enumerate(self.splines):
+            weights = self.weights(index, x)
+            used = weights > 0
+            if used.any():
+                values[used] = values[used] + weights[used] * splev(x[used], spline)
+                totals[used] = totals[used] + weights[used]
+        return values / totals
+
+    # Returns the root mean square difference between the splines and the readings
+    def residual(self, x, y):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        finite = np.isfinite(x) & np.isfinite(y)
+        return float(np.sqrt(np.mean((self(x[finite]) - y[finite]) ** 2)))
+
+    # Saves the splines to an npz file. The knots and coefficients of every window are joined into one array each,
+    # with the position each window starts at, so the file does not need pickle to be read.
+    def save(self, path):
+        offsets = np.cumsum([0] + [len(knots) for knots, coefficients, degree in self.splines])
+        np.savez(path, bounds=self.bounds, offsets=offsets,
+                 knots=np.concatenate([knots for knots, coefficients, degree in self.splines]),
+                 coefficients=np.concatenate([coefficients for knots, coefficients, degree in self.splines]),
+                 degrees=np.array([degree for knots, coefficients, degree in self.splines]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            offsets = saved['offsets']
+            splines = [(saved['knots'][start:end], saved['coefficients'][start:end], int(degree))
+                       for start, end, degree in zip(offsets[:-1], offsets[1:], saved['degrees'])]
+            return cls(saved['bounds'], splines)
+
+# -------------------------------
+# CACHE
+# -------------------------------
+
+# Returns the splines fitted to the readings, from the cache folder if they have been fitted before. The cache file is
+# named after a hash of the readings and the settings, so changing either of them fits the splines again. If the cache
+# folder can not be written to the splines are still returned.
+def cached_spline(x, y, cache_folder, degree=SPLINE_DEGREE, window=WINDOW_POINTS, overlap=OVERLAP_POINTS,
+                  smoothing=SMOOTHING, jobs=0):
+    x = np.ascontiguousarray(x, dtype=float)
+    y = np.ascontiguousarray(y, dtype=float)
+    digest = hashlib.sha256(x.tobytes())
+    digest.update(y.tobytes())
+    digest.update(json.dumps([CACHE_VERSION, degree, window, overlap, smoothing]).encode())
+    path = Path(cache_folder) / (digest.hexdigest() + '.npz')
+    if path.exists():
+        try:
+            return WindowedSpline.load(path)
+        except Exception:
+            pass
+    spline = WindowedSpline.fit(x, y, degree, window, overlap, smoothing, jobs)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        spline.save(path)
+    except OSError:
+        pass
+    return spline
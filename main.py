@@ -8,98 +8,652 @@
 
 from pathlib import Path  # Ensure we use the right paths to store our data
 from csv import writer  # To allow us to store our data in a csv file
-from sense_hat import SenseHat  # To allow us to take readings of the environment using the sense-hat sensors
 from datetime import datetime, timedelta  # To allow us to keep our program runtime under 3 hours
 import time  # Allows us to calculate the time between accelerometer readings
-from orbit import ISS  # Allows us to record the position of the ISS
 from logzero import logger, logfile  # Allows us to log errors if they occur and log code events
 import math  # Allows us to calculate the magnitude of the magnetometer readings
 from random import randint  # Allows us to generate random numbers
 import os  # Allows us to monitor the total file size of the files generated
+import struct  # Allows us to pack the readings into fixed size binary records
+import json  # Allows us to describe the layout of the binary records in the header of data.bin
+import hashlib  # Allows us to work out the checksum of each segment of the data
+import threading  # Allows us to take the sensor readings and write the data at the same time
+from collections import deque  # Allows us to hold the readings waiting to be processed in a fixed size buffer
+import argparse  # Allows the backend and the length of the run to be chosen when the program is started
+from Displacement import DisplacementIntegrator  # Allows us to calculate the displacement of the AstroPi
+from Hardware import BACKENDS, create_backend  # Allows us to take readings from the sense hat or without an Astro Pi
+from Hardware import Angle, Distance, Position  # Allows us to store the interpolated positions of the ISS
 
 # -------------------------------
-# INITIALISING VARIABLES
+# SETTINGS
 # -------------------------------
 
-# Creates the variable start_time at which the program starts
-start_time = datetime.now()
-
 # Creates the variable of base_folder, which has the file location where the program is located
 base_folder = Path(__file__).parent.resolve()
 
-# Creates the variable data_file and creates a csv file which is named data.csv in the file location of base_folder
-data_file = base_folder / "data.csv"
+# RUN_MINUTES is how long the readings are taken for, which leaves time for the program to finish within 3 hours
+RUN_MINUTES = 178.5
+
+# SENSOR_BACKEND chooses where the readings come from, 'astropi' uses the sense hat and the orbit library on the Astro
+# Pi, 'synthetic' makes up readings and the position of the ISS, and 'replay' plays back the data file or data folder
+# REPLAY_FILE recorded by an earlier run at REPLAY_SPEED times the speed it was recorded at, where a speed of 0 plays
+# back a row for every reading as fast as they are taken. The synthetic and replay backends let the program be run and
+# timed on a computer without an Astro Pi, and are described in Hardware.py
+SENSOR_BACKEND = 'astropi'
+REPLAY_FILE = base_folder / "replay.csv"
+REPLAY_SPEED = 1.0
+
+# Settings for how the data writer batches rows before they are written to data.csv
+# FLUSH_ROWS is how many rows are held in memory before they are written to the file
+# FLUSH_SECONDS is the longest time rows are held in memory before they are written to the file
+# FSYNC_SECONDS is how often the written rows are forced onto the SD card, so a power cut loses at most that much data
+FLUSH_ROWS = 50
+FLUSH_SECONDS = 5
+FSYNC_SECONDS = 30
+
+# RECORDING_FORMAT chooses how the readings are stored, 'csv' writes them as text to data.csv and 'binary' writes them
+# as fixed size records to data.bin, which is about a third of the size and much faster to write. DataAnalysis.py can
+# convert data.bin back into a csv file with the same header as data.csv
+RECORDING_FORMAT = 'csv'
+
+# RECORDING_LAYOUT chooses how the data file is split up, 'single' writes every reading to one data.csv or data.bin,
+# which is started again every time the program starts, and 'segments' writes the readings to numbered segment files
+# in the data folder, starting a new segment once the current one reaches SEGMENT_BYTES or has been written to for
+# SEGMENT_SECONDS. Every finished segment is added to the index file SEGMENT_INDEX in the data folder with its number
+# of rows and checksum, and when the program starts again it carries on in a new segment instead of overwriting the
+# data which was already recorded
+RECORDING_LAYOUT = 'segments'
+SEGMENT_BYTES = 64 * 1024 * 1024
+SEGMENT_SECONDS = 15 * 60
+SEGMENT_INDEX = 'index.jsonl'
+
+# ACQUISITION_MODE chooses how the readings are taken, 'loop' takes a reading, works out the data and writes it one
+# after another in the main while loop, and 'pipeline' uses separate threads for taking the readings, getting the ISS
+# position, working out the data and writing it, so a slow write or position never delays the next reading
+# BUFFER_SIZE is how many readings or rows each buffer of the pipeline can hold before the oldest ones are dropped
+ACQUISITION_MODE = 'pipeline'
+BUFFER_SIZE = 2000
+
+# SAMPLE_RATES is how many times a second each sensor is read, a row of data is made for every accelerometer reading
+# and uses the latest magnetometer reading and the ISS position at the time of the reading. A rate of None reads that
+# sensor as fast as possible. In the 'loop' mode every reading is taken for every row, so only the accelerometer rate
+# is used. The position rate is the rate the position service starts at
+SAMPLE_RATES = {'accelerometer': 50, 'magnetometer': 10, 'position': 1}
+
+# Settings for the position of the ISS
+# The position of the ISS is worked out by the orbit library in its own thread, and the position at the time of each
+# reading is interpolated between the two positions either side of it, or extrapolated from the last two positions if
+# the reading is newer than the last position. After every new position, the time until the next one is changed so
+# that extrapolating the last two positions to the new one would have been off by POSITION_ERROR_METRES, which
+# is at least as much as the error of any position given to a reading
+# POSITION_MIN_SECONDS and POSITION_MAX_SECONDS are the shortest and longest time between two positions
+# POSITION_FIXES is how many of the latest positions are kept to interpolate between
+# A reading more than POSITION_MAX_SECONDS newer than the last position is given the last position instead, because
+# the orbit library has stopped giving positions, and is counted as stale
+POSITION_ERROR_METRES = 10
+POSITION_MIN_SECONDS = 0.2
+POSITION_MAX_SECONDS = 10
+POSITION_FIXES = 16
+
+# Settings for the log
+# VERBOSE_LOGGING adds a message to the log for every reading which is added, this is useful for finding problems but
+# makes the log grow faster than the data file, so normally only the counters are logged
+# STATUS_SECONDS is how often a status record with the counters of the run is added to the log
+# ERROR_LOG_SECONDS is the shortest time between two log messages for the same error in the same reading, the errors
+# in between are still counted and the number of them is added to the next message
+VERBOSE_LOGGING = False
+STATUS_SECONDS = 60
+ERROR_LOG_SECONDS = 10
+
+# STAGES is the name of every stage of taking, working out and storing a reading which is timed while the program
+# runs, so a low sample rate can be traced to the stage which took the time
+# 'compass' and 'accelerometer' are the sense hat readings, 'iss_position' is getting the position of the ISS from the
+# orbit library, 'interpolate' is working out the position at the time of a reading, 'derive' is working out the data
+# of a row, 'write' is passing a row to the data writer, 'disk' is the data writer
+# writing its rows to the file, 'stats' is adding a row to the online statistics, 'sparkle' is setting a pixel of the
+# LED matrix, 'storage' is checking the storage budget and 'logging' is adding errors and status records to the log
+# STAGE_BIN_WIDTH is the width in seconds of each bin of the stage timings and STAGE_BINS is how many bins there are,
+# so the timings are counted up to STAGE_BIN_WIDTH * STAGE_BINS seconds and anything longer is counted in the last bin
+STAGES = ['compass', 'accelerometer', 'iss_position', 'interpolate', 'derive', 'write', 'disk', 'stats', 'sparkle',
+          'storage', 'logging']
+STAGE_BIN_WIDTH = 0.00001
+STAGE_BINS = 10000
+
+# Settings for the online statistics which are kept while the readings are taken
+# STATS_CHANNELS is the name of every reading in DATA_HEADER which statistics are kept for, and the sensor it comes from
+# STATS_WINDOW is how many of the latest readings the rolling minimum and maximum are taken over
+# SPIKE_SIGMA is how many standard deviations a reading has to be from the moving average to be counted as a spike
+# SPIKE_ALPHA is how much the moving average and moving variance move towards each new reading, so they follow the
+# slow change of the field around the orbit but not a sudden spike
+# SPIKE_WARMUP is how many readings of a channel are needed before spikes are looked for
+# SPIKES_KEPT is how many of the latest spikes of each channel are kept in the statistics file
+# STATS_SECONDS is how often the statistics are written to stats.json
+STATS_CHANNELS = {'Mag X': 'magnetometer', 'Mag Y': 'magnetometer', 'Mag Z': 'magnetometer',
+                  'Mag Magnitude': 'magnetometer', 'Acc X': 'accelerometer', 'Acc Y': 'accelerometer',
+                  'Acc Z': 'accelerometer'}
+STATS_WINDOW = 500
+SPIKE_SIGMA = 6
+SPIKE_ALPHA = 0.01
+SPIKE_WARMUP = 100
+SPIKES_KEPT = 20
+STATS_SECONDS = 60
+
+# Settings for the storage budget
+# STORAGE_LIMIT is the most bytes the output folder and the program files may take up together
+# STORAGE_CHECK_SECONDS is how often the real size of the files is checked, in between the bytes written by the data
+# writer are added to the size found at the last check
+# STORAGE_MARGIN_SECONDS is how long before the limit is projected to be reached that the program finishes, to leave
+# room for the last rows, the log and the summary
+STORAGE_LIMIT = 2999990000
+STORAGE_CHECK_SECONDS = 60
+STORAGE_MARGIN_SECONDS = 300
+
+# The header of the data file, which is the name of every reading in the list returned by get_sense_data
+DATA_HEADER = ['DateTime', 'Mag X', 'Mag Y', ' Mag Z', 'Mag Magnitude', 'Acc X', 'Acc Y', 'Acc Z', 'Displacement X',
+               'Displacement Y', 'Displacement Z', 'ISS Latitude', 'ISS Longitude', 'ISS Elevation']
+
+# The variables below are used by the functions and classes while the readings are being taken, and are created by
+# the main function when the program starts, so that nothing is read from the sensors when main.py is only imported
+# sense is the sense hat, or the synthetic or replay backend, which the readings are taken from
+# iss gives the position of the ISS
+# integrator calculates the displacement of the AstroPi from the accelerometer readings, it keeps the previous two
+# accelerations, their times and the velocity it needs between readings
+# storage is the storage budget of the run
+sense = None
+iss = None
+integrator = None
+storage = None
+
+# -------------------------------
+# LOGGING
+# -------------------------------
+
+# This class is used for logging while the readings are being taken, instead of adding a message to the log for every
+# reading. The trace method only adds its message to the log if VERBOSE_LOGGING is True. The count method adds to a
+# counter, such as the number of samples taken. The error method counts every error by its type and the reading it
+# happened in, and adds it to the log unless the same error in the same reading was already added in the last
+# ERROR_LOG_SECONDS. The status method adds one record to the log with the counters, the samples per second since the
+# last status, the errors and the stage timings, and is called every STATUS_SECONDS. A lock is used because the threads
+# of the pipeline all use the same counters.
+
+class RunLog:
+    def __init__(self, verbose=VERBOSE_LOGGING):
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.counters = {'samples': 0}
+        self.errors = {}
+        self.error_times = {}
+        self.suppressed = {}
+        self.last_status = time.monotonic()
+        self.last_samples = 0
+
+    def trace(self, message):
+        if self.verbose:
+            logger.info(message)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def error(self, e, field):
+        name = e.__class__.__name__
+        now = time.monotonic()
+        with self.lock:
+            fields = self.errors.setdefault(name, {})
+            fields[field] = fields.get(field, 0) + 1
+            key = (name, field)
+            if key in self.error_times and now - self.error_times[key] < ERROR_LOG_SECONDS:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return
+            self.error_times[key] = now
+            suppressed = self.suppressed.pop(key, 0)
+        start = time.perf_counter()
+        if suppressed:
+            logger.error(f'{name}: {e}) - {field}, {suppressed} more since the last message')
+        else:
+            logger.error(f'{name}: {e}) - {field}')
+        stage_timers.add('logging', time.perf_counter() - start)
+
+    def summary(self):
+        with self.lock:
+            return {'counters': dict(self.counters), 'errors': {name: dict(fields) for name, fields in
+                                                                self.errors.items()}}
+
+    def status_due(self):
+        return time.monotonic() - self.last_status >= STATUS_SECONDS
+
+    def status(self, extra=None):
+        start = time.perf_counter()
+        now = time.monotonic()
+        record = self.summary()
+        samples = record['counters']['samples']
+        record['samples_per_second'] = round((samples - self.last_samples) / (now - self.last_status), 2)
+        record['stages'] = stage_timers.compact()
+        if extra:
+            record.update(extra)
+        self.last_status = now
+        self.last_samples = samples
+        logger.info('Status ' + json.dumps(record))
+        stage_timers.add('logging', time.perf_counter() - start)
+
+
+# Creates the run_log variable which is used for logging while the readings are being taken
+run_log = RunLog()
+
+
+# -------------------------------
+# DATA WRITER
+# -------------------------------
+
+# This class keeps data.csv open for the whole run instead of opening and closing it for every reading. The rows are
+# kept in a list in memory and written to the file together once there are FLUSH_ROWS of them or FLUSH_SECONDS have
+# passed since the last write. Every FSYNC_SECONDS the file is also synced to the SD card as a checkpoint. The close
+# method writes any rows that are left and syncs the file, so no data is lost when the program finishes. The size of
+# the file is kept in size after every write, so the storage budget does not need to check the file itself.
+
+class DataWriter:
+    def __init__(self, path, header=None, mode='w', flush_rows=FLUSH_ROWS, flush_seconds=FLUSH_SECONDS,
+                 fsync_seconds=FSYNC_SECONDS):
+        self.path = path
+        self.file = open(path, mode, newline='')
+        self.csv_writer = writer(self.file)
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.fsync_seconds = fsync_seconds
+        self.rows = []
+        self.rows_written = 0
+        self.size = self.file.tell()
+        self.last_flush = time.monotonic()
+        self.last_fsync = self.last_flush
+        if header is not None:
+            self.csv_writer.writerow(header)
+            self.flush(sync=True)
+
+    # Adds a row to the list in memory and writes the list to the file if it is full or has been held for too long
+    def add_row(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
 
-# Creates the log file under the file path of the base_folder
-logfile(base_folder / "HHorizons.log")
+    # Writes the rows in memory to the file, and syncs the file to the SD card if it is time for a checkpoint
+    def flush(self, sync=False):
+        start = time.perf_counter()
+        if self.rows:
+            self.csv_writer.writerows(self.rows)
+            self.rows_written = self.rows_written + len(self.rows)
+            self.rows = []
+        self.file.flush()
+        self.size = self.file.tell()
+        self.last_flush = time.monotonic()
+        if sync or self.last_flush - self.last_fsync >= self.fsync_seconds:
+            os.fsync(self.file.fileno())
+            self.last_fsync = self.last_flush
+        stage_timers.add('disk', time.perf_counter() - start)
 
-# Adds to the log the start time
-logger.info(start_time)
+    # Writes the rows that are left, syncs and closes the file
+    def close(self):
+        if not self.file.closed:
+            self.flush(sync=True)
+            self.file.close()
 
-# Creates the sense variable with the properties of the sense hat
-sense = SenseHat()
 
-# Sets the orientation of the text displayed to be correct
-sense.set_rotation(270)
+# This class is used instead of DataWriter when RECORDING_FORMAT is 'binary'. It has the same add_row, flush and close
+# methods, but instead of text it stores every reading as a fixed size record of little endian numbers: the DateTime
+# as a 64 bit integer of nanoseconds since 1970-01-01 on the Astro Pi clock, followed by the 13 other readings as 64
+# bit floats, with the latitude and longitude in decimal degrees. Readings which could not be taken are stored as NaN,
+# and a DateTime which could not be taken as the smallest 64 bit integer, which numpy reads as NaT. A row which does not
+# have a reading, or None, for every column is rejected with a ValueError, so no reading is stored in the wrong column.
+# The file starts with a header of BINARY_HEADER_SIZE bytes which holds a JSON description of the columns, so every
+# record starts at a fixed offset and the file can be memory mapped. The records are packed into one chunk in memory
+# and written together, in the same way as the rows in DataWriter.
 
-# Displays on the LED Matrix the string Hello World as per computer science tradition
-sense.show_message('Hello World')
+BINARY_MAGIC = 'HHBIN'
+BINARY_HEADER_SIZE = 1024
+BINARY_EPOCH = datetime(1970, 1, 1)
+BINARY_MISSING_TIME = -2 ** 63
+
+
+class BinaryDataWriter:
+    def __init__(self, path, header=DATA_HEADER, mode='wb', flush_rows=FLUSH_ROWS, flush_seconds=FLUSH_SECONDS,
+                 fsync_seconds=FSYNC_SECONDS):
+        self.path = path
+        self.columns = len(header)
+        self.record = struct.Struct('<q' + 'd' * (self.columns - 1))
+        self.file = open(path, mode)
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.fsync_seconds = fsync_seconds
+        self.chunk = bytearray()
+        self.rows = 0
+        self.rows_written = 0
+        self.size = self.file.tell()
+        self.last_flush = time.monotonic()
+        self.last_fsync = self.last_flush
+        if self.size == 0:
+            schema = json.dumps({
+                'version': 1,
+                'header_size': BINARY_HEADER_SIZE,
+                'record_size': self.record.size,
+                'byte_order': 'little',
+                'columns': [[header[0], 'int64', 'ns since 1970-01-01']] +
+                           [[name, 'float64', ''] for name in header[1:]],
+            })
+            header_bytes = (BINARY_MAGIC + ' ' + schema).encode()
+            if len(header_bytes) >= BINARY_HEADER_SIZE:
+                raise ValueError('Binary header is larger than ' + str(BINARY_HEADER_SIZE) + ' bytes')
+            self.file.write(header_bytes.ljust(BINARY_HEADER_SIZE - 1) + b'\n')
+            self.flush(sync=True)
+
+    # Turns a row from get_sense_data into a record and adds it to the chunk in memory
+    def add_row(self, row):
+        if len(row) != self.columns:
+            raise ValueError('Row has ' + str(len(row)) + ' readings, expected ' + str(self.columns))
+        if row[0] is None:
+            values = [BINARY_MISSING_TIME]
+        else:
+            values = [(row[0] - BINARY_EPOCH) // timedelta(microseconds=1) * 1000]
+        for value in row[1:]:
+            if hasattr(value, 'degrees'):
+                value = value.degrees
+            try:
+                values.append(float(value))
+            except (TypeError, ValueError):
+                values.append(math.nan)
+        self.chunk += self.record.pack(*values)
+        self.rows = self.rows + 1
+        if self.rows >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    # Writes the chunk to the file, and syncs the file to the SD card if it is time for a checkpoint
+    def flush(self, sync=False):
+        start = time.perf_counter()
+        if self.chunk:
+            self.file.write(self.chunk)
+            self.rows_written = self.rows_written + self.rows
+            self.chunk = bytearray()
+            self.rows = 0
+        self.file.flush()
+        self.size = self.file.tell()
+        self.last_flush = time.monotonic()
+        if sync or self.last_flush - self.last_fsync >= self.fsync_seconds:
+            os.fsync(self.file.fileno())
+            self.last_fsync = self.last_flush
+        stage_timers.add('disk', time.perf_counter() - start)
+
+    # Writes the chunk that is left, syncs and closes the file
+    def close(self):
+        if not self.file.closed:
+            self.flush(sync=True)
+            self.file.close()
+
+
+# -------------------------------
+# SEGMENTED RECORDING
+# -------------------------------
+
+# Returns the SHA-256 checksum of the file at path and the number of line endings in it, reading it in blocks so a
+# large segment is never held in memory all at once
+def file_digest(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    lines = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+            lines = lines + block.count(b'\n')
+    return digest.hexdigest(), lines
+
+
+# Adds an entry to the index file and syncs it to the SD card, so the entry is never lost once it has been added. The
+# index file has one JSON entry on each line, so a power cut while it is being written can only damage the last line.
+def add_to_index(index_path, entry):
+    with open(index_path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# Returns the entries of the index file, skipping any line which was not finished
+def read_index(index_path):
+    entries = []
+    try:
+        with open(index_path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+# Cuts off the last row of a segment if it was only partly written when the program stopped, which for a csv segment
+# is anything after the last line ending and for a binary segment is anything after the last whole record. If the
+# program stopped while the header was being written the segment is left empty. Returns the number of rows in the
+# segment.
+def repair_segment(path):
+    size = os.path.getsize(path)
+    if path.suffix == '.bin':
+        with open(path, 'rb') as f:
+            header = f.read(BINARY_HEADER_SIZE)
+        try:
+            schema = json.loads(header.decode().split(' ', 1)[1])
+        except (ValueError, IndexError, UnicodeDecodeError):
+            os.truncate(path, 0)
+            return 0
+        rows = max(size - schema['header_size'], 0) // schema['record_size']
+        whole = schema['header_size'] + rows * schema['record_size']
+        if size > whole:
+            os.truncate(path, whole)
+        return rows
+    with open(path, 'rb+') as f:
+        position = size
+        while position > 0:
+            start = max(position - 4096, 0)
+            f.seek(start)
+            block = f.read(position - start)
+            end = block.rfind(b'\n')
+            if end >= 0:
+                if start + end + 1 < size:
+                    f.truncate(start + end + 1)
+                break
+            position = start
+        else:
+            f.truncate(0)
+    return max(file_digest(path)[1] - 1, 0)
+
+
+# Finds the segments in folder which are not in the index file, which are the segments that were being written when
+# the program stopped without closing them, repairs them and adds them to the index file. Returns how many there were.
+def recover_segments(folder, index_path):
+    indexed = {entry.get('segment') for entry in read_index(index_path)}
+    recovered = 0
+    for path in sorted(folder.glob('data-*.*')):
+        if path.name in indexed or path.suffix not in ('.csv', '.bin'):
+            continue
+        rows = repair_segment(path)
+        add_to_index(index_path, {'segment': path.name, 'rows': rows, 'bytes': os.path.getsize(path),
+                                  'sha256': file_digest(path)[0], 'recovered': True})
+        recovered = recovered + 1
+    return recovered
+
+
+# This class writes the readings to numbered segment files in a folder, such as data-00001.csv, using a DataWriter or
+# a BinaryDataWriter for the current segment, so it has the same add_row, flush and close methods. Once the current
+# segment reaches segment_bytes or has been written to for segment_seconds it is closed and a new one is started. When
+# a segment is closed it is synced to the SD card, its checksum is worked out and it is added to the index file, so
+# the index file lists every segment which is complete. When it is created it first recovers any segment which was
+# left open by a run which stopped without finishing, then starts the segment after the highest one in the folder, so
+# it never overwrites any data. rows_written and size are the totals of every segment written by this run.
+
+class SegmentedWriter:
+    def __init__(self, folder, header=DATA_HEADER, recording_format=RECORDING_FORMAT, segment_bytes=SEGMENT_BYTES,
+                 segment_seconds=SEGMENT_SECONDS):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.header = header
+        self.recording_format = recording_format
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.index_path = self.folder / SEGMENT_INDEX
+        self.run_start = str(datetime.now())
+        self.recovered = recover_segments(self.folder, self.index_path)
+        self.number = 0
+        for path in self.folder.glob('data-*.*'):
+            try:
+                self.number = max(self.number, int(path.stem.split('-')[1]))
+            except (IndexError, ValueError):
+                pass
+        self.segments = 0
+        self.closed_rows = 0
+        self.closed_size = 0
+        self.writer = None
+        self.segment_start = None
+        self.lock = threading.Lock()
+        self.open_segment()
+
+    # The totals are read under the lock, because the writer thread closes the segment and adds it to the totals while
+    # the main thread can be reading them for the storage budget and the status records
+    @property
+    def rows_written(self):
+        with self.lock:
+            return self.closed_rows + (self.writer.rows_written if self.writer is not None else 0)
+
+    @property
+    def size(self):
+        with self.lock:
+            return self.closed_size + (self.writer.size if self.writer is not None else 0)
+
+    def open_segment(self):
+        self.number = self.number + 1
+        if self.recording_format == 'binary':
+            writer = BinaryDataWriter(self.folder / 'data-{:05}.bin'.format(self.number), header=self.header)
+        else:
+            writer = DataWriter(self.folder / 'data-{:05}.csv'.format(self.number), header=self.header)
+        with self.lock:
+            self.writer = writer
+        self.segment_start = time.monotonic()
+
+    def close_segment(self):
+        self.writer.close()
+        sha256 = file_digest(self.writer.path)[0]
+        add_to_index(self.index_path, {'segment': self.writer.path.name, 'rows': self.writer.rows_written,
+                                       'bytes': self.writer.size, 'sha256': sha256, 'run_start': self.run_start,
+                                       'closed': str(datetime.now())})
+        with self.lock:
+            self.closed_rows = self.closed_rows + self.writer.rows_written
+            self.closed_size = self.closed_size + self.writer.size
+            self.segments = self.segments + 1
+            self.writer = None
+
+    def add_row(self, row):
+        self.writer.add_row(row)
+        if (self.writer.size >= self.segment_bytes or
+                time.monotonic() - self.segment_start >= self.segment_seconds):
+            self.close_segment()
+            self.open_segment()
+
+    def flush(self, sync=False):
+        if self.writer is not None:
+            self.writer.flush(sync)
+
+    def close(self):
+        if self.writer is not None:
+            self.close_segment()
+
+    def summary(self):
+        return {'folder': str(self.folder), 'segments': self.segments, 'recovered_segments': self.recovered,
+                'last_segment': self.number}
+
+
+# -------------------------------
+# STORAGE BUDGET
+# -------------------------------
 
-# Adds to log that the time variables and base folders have been created
-logger.info('Time Variables & Base Folders Created')
+# This class keeps track of how much space the program is using, so the 3 GB limit on the Astro Pi is never exceeded
+# without having to find the size of every file for every reading. Every STORAGE_CHECK_SECONDS the check method uses
+# os.stat to find the real size of every file in the output folder and its sub folders, which holds the data, the log,
+# the statistics and the summary, and adds the size of the program files which is only found once because they never
+# change. In between checks the bytes written by the data writer since the last
+# check are added to that size. At every check the rate the files are growing at is worked out, which is used to
+# project how long is left until the limit is reached. The full method returns True once the limit is reached or is
+# projected to be reached within STORAGE_MARGIN_SECONDS, so the program can finish before the limit.
 
-# Declares the variables which is being used to calculate the displacement of the AstroPi
-# V1 is the instantaneous velocity of the previous dataset
-# V2 is the instantaneous velocity of the A1 dataset
-# A1 is the previous acceleration
-# A2 is the acceleration from two datasets ago
-# Dis is the displacement of the AstroPi between the datasets of A0 and A1
-# time1 is the time when A1 values is taken
-# time1_2 is the time when A2 values is taken
-# time2 is the time when the current acceleration values is taken
-# The variables have an underscore with either x,y or z which refers to which axis the variable holds the value for
+# Returns the size in bytes of the file at path, or of every file in it and its sub folders if it is a folder, or 0 if
+# it does not exist. A file which is removed while the folder is being measured is skipped.
+def path_size(path):
+    if not os.path.isdir(path):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+    size = 0
+    for folder, folders, files in os.walk(path):
+        for name in files:
+            try:
+                size = size + os.stat(os.path.join(folder, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
 
 
-V1_x = float(0)
-V2_x = float(0)
-A1_x = float(0)
-A2_x = float(0)
-Dis_x = float(0)
+# Returns every program file in base_folder which is not inside output_folder, because the files inside the output
+# folder are already measured with it
+def program_files(output_folder):
+    output_folder = Path(output_folder).resolve()
+    return [path for path in sorted(base_folder.glob('*.py'))
+            if output_folder not in path.resolve().parents]
 
-V1_y = float(0)
-V2_y = float(0)
-A1_y = float(0)
-A2_y = float(0)
-Dis_y = float(0)
 
-V1_z = float(0)
-V2_z = float(0)
-A1_z = float(0)
-A2_z = float(0)
-Dis_z = float(0)
+class StorageBudget:
+    def __init__(self, data_writer, paths, fixed_paths, limit=STORAGE_LIMIT):
+        self.data_writer = data_writer
+        self.paths = paths
+        self.limit = limit
+        self.fixed = 0
+        for path in fixed_paths:
+            self.fixed = self.fixed + os.stat(path).st_size
+        self.measured = 0
+        self.writer_size = 0
+        self.rate = 0
+        self.last_check = None
+        self.checks = 0
+        self.check()
 
-# Gets the accelerometer values, which will be stored in the A2 variables in the x,y and z axes and
-# the time for which the accelerometer took the readings
+    def check(self):
+        now = time.monotonic()
+        writer_size = self.data_writer.size
+        measured = self.fixed
+        for path in self.paths:
+            measured = measured + path_size(path)
+        if self.last_check is not None and now > self.last_check:
+            self.rate = max(measured - self.measured, 0) / (now - self.last_check)
+        self.measured = measured
+        self.writer_size = writer_size
+        self.last_check = now
+        self.checks = self.checks + 1
 
-acc = sense.get_accelerometer_raw()
-time1_2_x = time.time()
-time1_2_y = time1_2_x
-time1_2_z = time1_2_x
+    def used(self):
+        return self.measured + self.data_writer.size - self.writer_size
 
-A2_x = acc["x"]
-A2_y = acc["y"]
-A2_z = acc["z"]
+    def seconds_to_limit(self):
+        if not self.rate:
+            return None
+        return max(self.limit - self.used(), 0) / self.rate
 
-# Gets the accelerometer values, which will be stored in the A1 variables for the x,y and z axes and
-# stores the time for which the accelerometer took the readings
+    def full(self):
+        if time.monotonic() - self.last_check >= STORAGE_CHECK_SECONDS:
+            self.check()
+        if self.used() >= self.limit:
+            return True
+        seconds_to_limit = self.seconds_to_limit()
+        return seconds_to_limit is not None and seconds_to_limit <= STORAGE_MARGIN_SECONDS
 
-acc = sense.get_accelerometer_raw()
-time1_x = time.time()
-time1_y = time1_x
-time1_z = time1_x
-A1_x = acc["x"]
-A1_y = acc["y"]
-A1_z = acc["z"]
+    def summary(self):
+        seconds_to_limit = self.seconds_to_limit()
+        return {'used_bytes': self.used(), 'limit_bytes': self.limit, 'bytes_per_second': round(self.rate, 1),
+                'seconds_to_limit': None if seconds_to_limit is None else round(seconds_to_limit),
+                'checks': self.checks}
 
 
 # -------------------------------
@@ -107,298 +661,1114 @@ A1_z = acc["z"]
 # -------------------------------
 
 # This is the main function which has the sensor readings and stores them into a list which is called sense_data and
-# calculates the displacement of the AstroPi using our formula. Every sensor reading is done in a try-except to
-# prevent any errors from taking those readings crashing the program, and it reports that error in the log and moves
-# on. After the sensor reading is added to the sense_data list it is added to the log that it has been added,
-# this also applies to the creation of the list and the displacement calculation. In the function at the start,
-# it adds to the log the time at which it is called at. We use global variables to allow the function to access the
-# starting data which is collected at the start outside the function.
-
-# The function below is based off the Raspberry Pi Foundation Sense HAT Data Logger guide, specifically from the section
-# Getting the data from the sense hat
-
-def get_sense_data():
-    # Declaring the global variables needed
-
-    global V1_x
-    global V2_x
-    global A1_x
-    global A2_x
-    global Dis_x
-
-    global V1_y
-    global V2_y
-    global A1_y
-    global A2_y
-    global Dis_y
-
-    global V1_z
-    global V2_z
-    global A1_z
-    global A2_z
-    global Dis_z
-
-    global time1_x
-    global time1_y
-    global time1_z
-
-    global time1_2_x
-    global time1_2_y
-    global time1_2_z
+# calculates the displacement of the AstroPi using our formula. It is split into three steps so the pipeline can run
+# each step in its own thread: read_sensors takes the magnetometer and accelerometer readings and the time they were
+# taken, derive_data works out the magnitude and displacement and makes the sense_data list, and get_sense_data runs
+# both steps with the position of the ISS. Every sensor reading is done in a try-except to prevent any errors from
+# taking those readings crashing the program, and it reports that error in the log and moves on. After the sensor
+# reading is added to the sense_data list it is added to the log that it has been added, this also applies to the
+# creation of the list and the displacement calculation. In the function at the start, it adds to the log the time
+# at which it is called at. The displacement is calculated by the integrator variable, which holds the starting data
+# which is collected by the main function before the readings start.
+
+# The functions below are based off the Raspberry Pi Foundation Sense HAT Data Logger guide, specifically from the
+# section Getting the data from the sense hat
+
+def read_magnetometer():
+    # Takes the full magnetometer readings
+    mag = None
+    start = time.perf_counter()
+    try:
+        mag = sense.get_compass_raw()
+        run_log.trace('Mag Variable Created - Function')
+    except Exception as e:
+        run_log.error(e, 'Magnetometer')
+    stage_timers.add('compass', time.perf_counter() - start)
+    return mag
+
+
+# The scheduler reads the magnetometer less often than the accelerometer, so it passes the latest magnetometer
+# readings in mag and read_mag as False, and mag is left as None if the latest magnetometer reading failed, otherwise
+# the magnetometer is read here as well
+
+def read_sensors(mag=None, read_mag=True):
+    function_calltime = None
+    acc = None
+    time2_x = None
 
     # Adds to the log the time at which the function was called at
     try:
         function_calltime = datetime.now()
-        logger.info(function_calltime)
+        run_log.trace(function_calltime)
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'DateTime')
+
+    if read_mag:
+        mag = read_magnetometer()
+    run_log.count('samples')
+
+    # Takes the full accelerometer readings and the time of the accelerometer readings which will be used in the
+    # calculation of the displacement.
+    start = time.perf_counter()
+    try:
+        acc = sense.get_accelerometer_raw()
+        time2_x = time.time()
+        run_log.trace('Acc Variable Created - Function')
+    except Exception as e:
+        run_log.error(e, 'Accelerometer')
+    stage_timers.add('accelerometer', time.perf_counter() - start)
+    return [function_calltime, mag, acc, time2_x]
+
+
+def derive_data(sample, location):
+    # Takes the readings from the sample made by read_sensors
+    function_calltime, mag, acc, time2 = sample
 
     # Creates the list named sense_data
     try:
         sense_data = []
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'sense_data')
+
+    # If a reading can not be taken or worked out, None is appended in its place, so every reading after it stays in
+    # its own column of the data file and is not moved into the column of the reading before it
 
     # Appends to the list the datetime
     try:
         sense_data.append(function_calltime)
-        logger.info('Time Added - Function')
+        run_log.trace('Time Added - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'DateTime')
+        sense_data.append(None)
 
-    # Appends to the list the magnetometer readings, first it takes the full readings and appends them separately to
-    # list.
+    # Appends to the list the magnetometer readings separately.
     # It also calculates the magnitude of the x,y,z readings using the formula the square root of x^2+y^2+z^2, it
     # appends that too to the list.
 
-    try:
-        mag = sense.get_compass_raw()
-        logger.info('Mag Variable Created - Function')
-    except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
     try:
         sense_data.append(mag["x"])
-        logger.info('Mag X added - Function')
+        run_log.trace('Mag X added - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'Mag X')
+        sense_data.append(None)
     try:
         sense_data.append(mag["y"])
-        logger.info('Mag Y added - Function')
+        run_log.trace('Mag Y added - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'Mag Y')
+        sense_data.append(None)
     try:
         sense_data.append(mag["z"])
-        logger.info('Mag Z added - Function')
+        run_log.trace('Mag Z added - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'Mag Z')
+        sense_data.append(None)
     try:
         sense_data.append(math.sqrt((pow(mag["y"], 2)) + (pow(mag["x"], 2)) + (pow(mag["z"], 2))))
-        logger.info('Mag Magnitude Calculated And Added - Function')
+        run_log.trace('Mag Magnitude Calculated And Added - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'Mag Magnitude')
+        sense_data.append(None)
 
-    # Appends accelerometer readings, first it takes the full readings and appends them separately to list under
-    # their axes. It takes the time of the accelerometer readings which will be used in the calculation of the
-    # displacement.
+    # Appends accelerometer readings separately to list under their axes.
 
-    try:
-        acc = sense.get_accelerometer_raw()
-        time2_x = time.time()
-        time2_y = time2_x
-        time2_z = time2_x
-        logger.info('Acc Variable Created - Function')
-    except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
     try:
         sense_data.append(acc["x"])
-        logger.info('Acc X Added - Function')
+        run_log.trace('Acc X Added - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'Acc X')
+        sense_data.append(None)
     try:
         sense_data.append(acc["y"])
-        logger.info('Acc Y added - Function')
+        run_log.trace('Acc Y added - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'Acc Y')
+        sense_data.append(None)
     try:
         sense_data.append(acc["z"])
-        logger.info('Azz Z added - Function')
+        run_log.trace('Azz Z added - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'Acc Z')
+        sense_data.append(None)
 
-    # We now use our displacement formula to calculate initially the previous velocity of the AstroPi. Then using the
-    # calculated velocity and other data it will calculate the displacement of the AstroPi for that dataset. We do
-    # this for all three axes to allow us to use the data collected to map the journey of the AstroPi in 3D and 2D
-    # space against the magnetometer readings. We also add to the logg that the displacement is calculated when the
-    # displacement is calculated. We cycle the readings so A2 has the value of A1 and A1 has the value of the current
-    # acceleration, this happens for all the other variables as well
+    # We now use the integrator to calculate the displacement of the AstroPi since the previous reading, using our
+    # displacement formula. We do this for all three axes to allow us to use the data collected to map the journey
+    # of the AstroPi in 3D and 2D space against the magnetometer readings. The integrator cycles the readings so the
+    # next displacement uses this acceleration and time.
 
     try:
-        V1_x = 0.5 * (A1_x + A2_x) * (time1_x - time1_2_x) + V2_x
-        Dis_x = 0.25 * (acc["x"] + A1_x) * (time2_x - time1_x) + V1_x * (time2_x - time1_x)
-        sense_data.append(Dis_x)
-        A2_x = A1_x
-        A1_x = acc["x"]
-        V2_x = V1_x
-        time1_2_x = time1_x
-        time1_x = time2_x
-        logger.info('Displacement X calculated - Function')
+        sense_data.extend(integrator.update([acc["x"], acc["y"], acc["z"]], time2))
+        run_log.trace('Displacement calculated - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
-
-    try:
-        V1_y = 0.5 * (A1_y + A2_y) * (time1_y - time1_2_y) + V2_y
-        Dis_y = 0.25 * (acc["y"] + A1_y) * (time2_y - time1_y) + V1_y * (time2_y - time1_y)
-        sense_data.append(Dis_y)
-        A2_y = A1_y
-        A1_y = acc["y"]
-        V2_y = V1_y
-        time1_2_y = time1_y
-        time1_y = time2_y
-        logger.info('Displacement Y calculated - Function')
-    except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
-
-    try:
-        V1_z = 0.5 * (A1_z + A2_z) * (time1_z - time1_2_z) + V2_z
-        Dis_z = 0.25 * (acc["z"] + A1_z) * (time2_z - time1_z) + V1_z * (time2_z - time1_z)
-        sense_data.append(Dis_z)
-        A2_z = A1_z
-        A1_z = acc["z"]
-        V2_z = V1_z
-        time1_2_z = time1_z
-        time1_z = time2_z
-        logger.info('Displacement Z calculated - Function')
-    except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'Displacement')
+        sense_data.extend([None, None, None])
 
     # Appends to the list the longitude, latitude and elevation of the ISS
-    # This is done by storing the ISS location in a variable called location
-    # Then it extracts the longitude, latitude and elevation and appends it to the list
+    # This is done by extracting the longitude, latitude and elevation from the ISS location in the variable location
+    # and appending it to the list
     # We take the ISS position data to check our calculated displacements from, but if our calculated displacement
     # is wrong we can use this data to plot our graph and calculate the function of that graph.
 
-    try:
-        location = ISS.coordinates()
-        logger.info('Location Variable Created - Function')
-    except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
     try:
         sense_data.append(location.latitude)
-        logger.info('Latitude added - Function')
+        run_log.trace('Latitude added - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'ISS Latitude')
+        sense_data.append(None)
     try:
         sense_data.append(location.longitude)
-        logger.info('Longitude added - Function')
+        run_log.trace('Longitude added - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'ISS Longitude')
+        sense_data.append(None)
     try:
         sense_data.append(location.elevation.km)
-        logger.info('Elevation added - Function')
+        run_log.trace('Elevation added - Function')
     except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
+        run_log.error(e, 'ISS Elevation')
+        sense_data.append(None)
+    return sense_data
+
+
+# If a position service is given in positions, the ISS location is interpolated from it at the time of the readings,
+# otherwise it is worked out by the orbit library for every reading
+
+def get_sense_data(positions=None):
+    sample = read_sensors()
+
+    # Stores the ISS location in a variable called location
+    location = None
+    start = time.perf_counter()
+    try:
+        if positions is not None:
+            location = positions.position_at(sample_time(sample))
+        else:
+            location = iss.coordinates()
+        run_log.trace('Location Variable Created - Function')
+    except Exception as e:
+        run_log.error(e, 'ISS Position')
+    stage_timers.add('iss_position' if positions is None else 'interpolate', time.perf_counter() - start)
+    start = time.perf_counter()
+    sense_data = derive_data(sample, location)
+    stage_timers.add('derive', time.perf_counter() - start)
     return sense_data
 
 
 # -------------------------------
-# WRITING THE HEADER
+# SCHEDULER
 # -------------------------------
 
-# Adds to the csv file named data.csv the header for the data collected, it does that by using a with open statement
-# which closes it when the code inside it finishes We also use the try except method to prevent any errors from
-# crashing the program Also, we add to the log that it has created the data writer variable and that the header has
-# been added.
+# This class counts values, such as how late a reading was, in a fixed number of bins of bin_width seconds, so it
+# uses the same amount of memory however long the program runs. Values bigger than the last bin are counted in the
+# last bin. The percentile method returns the top of the bin which the given percentage of the values are under.
 
-# The code below is based off the Raspberry Pi Foundation Sense HAT Data Logger guide, specifically from the section
-# Adding a header to the CSV file.
+class Histogram:
+    def __init__(self, bin_width=0.0001, bins=1000):
+        self.bin_width = bin_width
+        self.counts = [0] * bins
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
 
+    def add(self, value):
+        index = int(value / self.bin_width)
+        if index >= len(self.counts):
+            index = len(self.counts) - 1
+        elif index < 0:
+            index = 0
+        self.counts[index] = self.counts[index] + 1
+        self.count = self.count + 1
+        self.total = self.total + value
+        if value > self.maximum:
+            self.maximum = value
+
+    # Returns a copy of the histogram, so its percentiles can be worked out while this one keeps counting
+    def copy(self):
+        histogram = Histogram(self.bin_width, len(self.counts))
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.maximum = self.maximum
+        return histogram
+
+    def percentile(self, percent):
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative = cumulative + count
+            if cumulative and cumulative >= self.count * percent / 100:
+                return min((index + 1) * self.bin_width, self.maximum)
+        return 0
+
+
+# This class holds the target rate of one sensor, the time its next reading is due at and how well the target rate
+# has been kept to. The jitter is how late each reading was compared to when it was due, and missed counts the
+# readings which were skipped because the previous one was more than a whole period late.
+
+class Channel:
+    def __init__(self, name, rate):
+        self.name = name
+        self.rate = rate
+        self.period = 1 / rate if rate else 0
+        self.deadline = None
+        self.jitter = Histogram()
+        self.samples = 0
+        self.missed = 0
+        self.first = None
+        self.last = None
+
+    def summary(self):
+        achieved_rate = None
+        if self.samples > 1 and self.last > self.first:
+            achieved_rate = (self.samples - 1) / (self.last - self.first)
+        return {'target_rate': self.rate, 'achieved_rate': achieved_rate, 'samples': self.samples,
+                'missed_deadlines': self.missed,
+                'jitter_ms': {'p50': round(self.jitter.percentile(50) * 1000, 3),
+                              'p90': round(self.jitter.percentile(90) * 1000, 3),
+                              'p99': round(self.jitter.percentile(99) * 1000, 3),
+                              'max': round(self.jitter.maximum * 1000, 3)}}
+
+
+# This class keeps one or more sensors to their target rates. The wait method sleeps until the earliest time a
+# reading is due, using time.monotonic so changes to the clock of the Astro Pi do not affect it, and returns the
+# names of the sensors which are due. Each deadline is moved on by exactly one period, so the readings stay on a
+# regular grid instead of drifting by however long each reading took. If a sensor falls more than a period behind,
+# the readings it missed are counted and it carries on from the next deadline instead of trying to catch up.
+
+class Scheduler:
+    def __init__(self, rates):
+        self.channels = [Channel(name, rate) for name, rate in rates.items()]
+
+    def wait(self):
+        now = time.monotonic()
+        for channel in self.channels:
+            if channel.deadline is None:
+                channel.deadline = now
+        deadline = min(channel.deadline for channel in self.channels)
+        if deadline > now:
+            time.sleep(deadline - now)
+            now = time.monotonic()
+        due = []
+        for channel in self.channels:
+            if channel.deadline <= now:
+                channel.jitter.add(now - channel.deadline)
+                channel.samples = channel.samples + 1
+                if channel.first is None:
+                    channel.first = now
+                channel.last = now
+                if channel.period:
+                    channel.deadline = channel.deadline + channel.period
+                    if channel.deadline <= now:
+                        missed = int((now - channel.deadline) / channel.period) + 1
+                        channel.missed = channel.missed + missed
+                        channel.deadline = channel.deadline + missed * channel.period
+                else:
+                    channel.deadline = now
+                due.append(channel.name)
+        return due
+
+    def summary(self):
+        return {channel.name: channel.summary() for channel in self.channels}
+
+
+# -------------------------------
+# STAGE TIMERS
+# -------------------------------
+
+# This class keeps how long each of the STAGES took every time it ran, in a histogram of STAGE_BINS bins for each
+# stage, so timing every reading only adds a count to a fixed list and the memory used never grows. The time of a
+# stage is measured with time.perf_counter around it and passed to the add method. The compact method returns the
+# count, median, 99th percentile and maximum of every stage in microseconds for the status records in the log, and the
+# summary method returns the full timings of every stage for the summary at the end of the run, including the total
+# time of each stage so the stage which took most of the time can be found. A lock is used because the stages are
+# timed in the different threads of the pipeline.
+
+class StageTimers:
+    def __init__(self, stages=STAGES):
+        self.lock = threading.Lock()
+        self.histograms = {stage: Histogram(STAGE_BIN_WIDTH, STAGE_BINS) for stage in stages}
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.histograms[stage].add(seconds)
+
+    # Returns a copy of the histogram of every stage, the lock is only held while they are copied so the threads
+    # timing the stages are not held up while the percentiles are worked out
+    def snapshot(self):
+        with self.lock:
+            return {stage: histogram.copy() for stage, histogram in self.histograms.items()}
+
+    def compact(self):
+        return {stage: [histogram.count, round(histogram.percentile(50) * 1e6),
+                        round(histogram.percentile(99) * 1e6), round(histogram.maximum * 1e6)]
+                for stage, histogram in self.snapshot().items() if histogram.count}
+
+    def summary(self):
+        return {stage: {'count': histogram.count, 'total_seconds': round(histogram.total, 6),
+                        'mean_us': round(histogram.total / histogram.count * 1e6, 1) if histogram.count else 0,
+                        'p50_us': round(histogram.percentile(50) * 1e6),
+                        'p90_us': round(histogram.percentile(90) * 1e6),
+                        'p99_us': round(histogram.percentile(99) * 1e6), 'max_us': round(histogram.maximum * 1e6)}
+                for stage, histogram in self.snapshot().items()}
+
+
+# Creates the stage_timers variable which times the stages while the readings are being taken
+stage_timers = StageTimers()
+
+
+# -------------------------------
+# ONLINE STATISTICS
+# -------------------------------
+
+# This class keeps the statistics of one channel of the readings while they are being taken, using the same amount of
+# memory however many readings there are. The mean and variance of every reading so far are kept with Welford's
+# method, which adds each reading to the mean and the sum of squared differences from the mean without keeping the
+# readings, and does not lose accuracy when the variance is small compared to the mean. The rolling minimum and
+# maximum of the latest STATS_WINDOW readings are kept in two deques, where a reading is removed from the back once a
+# newer reading is lower, or higher, than it, so the front of each deque is always the minimum, or maximum, of the
+# window. A reading is counted as a spike if it is more than SPIKE_SIGMA standard deviations from a moving average
+# and moving variance which follow the readings with the weight SPIKE_ALPHA, and the latest SPIKES_KEPT spikes are
+# kept with their time, value and number of standard deviations. A spike only moves the moving average and moving
+# variance as far as a reading SPIKE_SIGMA standard deviations away would, so one bad reading does not hide the ones
+# after it. Readings which are missing or not a number are only counted.
+
+class RunningStatistics:
+    def __init__(self, window=STATS_WINDOW, sigma=SPIKE_SIGMA, alpha=SPIKE_ALPHA, warmup=SPIKE_WARMUP,
+                 kept=SPIKES_KEPT):
+        self.window = window
+        self.sigma = sigma
+        self.alpha = alpha
+        self.warmup = warmup
+        self.count = 0
+        self.missing = 0
+        self.mean = 0.0
+        self.squares = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.minima = deque()
+        self.maxima = deque()
+        self.moving_mean = 0.0
+        self.moving_variance = 0.0
+        self.spikes = 0
+        self.recent_spikes = deque(maxlen=kept)
+
+    def add(self, value, when=None):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = math.nan
+        if value != value:
+            self.missing = self.missing + 1
+            return
+        self.count = self.count + 1
+        difference = value - self.mean
+        self.mean = self.mean + difference / self.count
+        self.squares = self.squares + difference * (value - self.mean)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((self.count, value))
+        if self.minima[0][0] <= self.count - self.window:
+            self.minima.popleft()
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((self.count, value))
+        if self.maxima[0][0] <= self.count - self.window:
+            self.maxima.popleft()
+
+        if self.count == 1:
+            self.moving_mean = value
+            return
+        deviation = value - self.moving_mean
+        if self.count > self.warmup and self.moving_variance > 0:
+            sigmas = deviation / math.sqrt(self.moving_variance)
+            if abs(sigmas) > self.sigma:
+                self.spikes = self.spikes + 1
+                self.recent_spikes.append([str(when), value, round(sigmas, 1)])
+                deviation = math.copysign(self.sigma * math.sqrt(self.moving_variance), deviation)
+        self.moving_mean = self.moving_mean + self.alpha * deviation
+        self.moving_variance = (1 - self.alpha) * (self.moving_variance + self.alpha * deviation ** 2)
+
+    def variance(self):
+        return self.squares / (self.count - 1) if self.count > 1 else 0.0
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0, 'missing': self.missing}
+        return {'count': self.count, 'missing': self.missing, 'mean': round(self.mean, 6),
+                'std': round(math.sqrt(self.variance()), 6), 'min': self.minimum, 'max': self.maximum,
+                'rolling_min': self.minima[0][1], 'rolling_max': self.maxima[0][1], 'spikes': self.spikes,
+                'recent_spikes': list(self.recent_spikes)}
+
+
+# This class keeps the running statistics of every channel in STATS_CHANNELS. The add method is given every row made by
+# get_sense_data or derive_data and adds each channel of it to its statistics. In the pipeline the magnetometer is read
+# less often than the accelerometer, so the same magnetometer reading is in several rows, and magnetometer is only True
+# for the first of them which is added, otherwise the repeated readings would be counted again and would make the moving
+# variance too small. Every row has a column for every reading in DATA_HEADER, with None where a reading failed, so a
+# channel is only counted as missing if its own reading failed. The write method writes the statistics to a JSON file,
+# first to a temporary file which then replaces the old one, so the file is never left half written, and is called every
+# STATS_SECONDS. This gives a quick look at the readings during and after the run without reading the whole data file. A
+# lock is used because the rows are added in the derive thread of the pipeline while the file is written from the main
+# while loop.
+
+class OnlineStatistics:
+    def __init__(self, channels=STATS_CHANNELS, header=DATA_HEADER):
+        names = [name.strip() for name in header]
+        self.columns = {channel: names.index(channel) for channel in channels}
+        self.sensors = dict(channels)
+        self.lock = threading.Lock()
+        self.channels = {channel: RunningStatistics() for channel in channels}
+        self.rows = 0
+        self.last_write = time.monotonic()
+
+    def add(self, row, magnetometer=True):
+        start = time.perf_counter()
+        with self.lock:
+            self.rows = self.rows + 1
+            for channel, column in self.columns.items():
+                if self.sensors[channel] == 'magnetometer' and not magnetometer:
+                    continue
+                self.channels[channel].add(row[column] if column < len(row) else None, row[0] if row else None)
+        stage_timers.add('stats', time.perf_counter() - start)
+
+    def summary(self):
+        with self.lock:
+            return {'rows': self.rows,
+                    'channels': {channel: statistics.summary() for channel, statistics in self.channels.items()}}
+
+    def write_due(self):
+        return time.monotonic() - self.last_write >= STATS_SECONDS
+
+    def write(self, path):
+        self.last_write = time.monotonic()
+        summary = self.summary()
+        summary['time'] = str(datetime.now())
+        temporary = Path(str(path) + '.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(summary, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+
+# -------------------------------
+# ISS POSITION
+# -------------------------------
+
+# Returns the time in seconds since 1970 a sample made by read_sensors was taken at, which is the time of the
+# accelerometer reading, or the time read_sensors was called if the accelerometer could not be read
+def sample_time(sample):
+    function_calltime, mag, acc, time2 = sample
+    if time2 is not None:
+        return time2
+    if function_calltime is not None:
+        return function_calltime.timestamp()
+    return None
+
+
+# Returns the distance in metres between two positions, which are lists of the latitude and longitude in degrees and
+# the elevation in km. The distance along the ground is worked out as if the Earth were flat between them, which is
+# accurate for the short distances between a position and its interpolated value.
+def position_error(a, b):
+    radius = 6371000 + 1000 * b[2]
+    north = math.radians(a[0] - b[0]) * radius
+    east = math.radians((a[1] - b[1] + 180) % 360 - 180) * radius * math.cos(math.radians(b[0]))
+    return math.sqrt(north ** 2 + east ** 2 + (1000 * (a[2] - b[2])) ** 2)
+
+
+# This class is the position service. Its thread gets the position of the ISS from the orbit library and keeps the
+# latest POSITION_FIXES positions with the time each was worked out, so the thread taking the readings never waits for
+# the orbit library. The position_at method returns the position at any time, by interpolating between the two kept
+# positions either side of it in a straight line, or extrapolating from the last two if the time is after the last
+# position. A time before the first kept position, which happens when the readings are worked out later than they were
+# taken, is extrapolated back from the first two and counted as stale, or given the first position if it is more than
+# POSITION_MAX_SECONDS before it. The longitudes are kept without jumping from 180 to -180 degrees, so the interpolation
+# works across the date line. Every new position is compared with the extrapolation of the two before it, that error is
+# counted in a histogram, and the time until the next position is scaled by the square root of POSITION_ERROR_METRES
+# over the error, because the error grows with the square of the time between positions.
+
+class PositionService:
+    def __init__(self, rate=SAMPLE_RATES['position'], error_metres=POSITION_ERROR_METRES,
+                 min_seconds=POSITION_MIN_SECONDS, max_seconds=POSITION_MAX_SECONDS, fixes=POSITION_FIXES):
+        self.error_metres = error_metres
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.interval = min(max(1 / rate if rate else min_seconds, min_seconds), max_seconds)
+        self.shortest_interval = self.interval
+        self.longest_interval = self.interval
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.fixes = deque(maxlen=fixes)
+        self.error = Histogram(bin_width=0.5, bins=2000)
+        self.counts = {'fixes': 0, 'interpolated': 0, 'extrapolated': 0, 'stale': 0, 'missing': 0}
+        self.thread = threading.Thread(target=self.propagate, name='Position', daemon=True)
+
+    # Gets the first two positions before the readings start, so the position of the first reading can already be
+    # extrapolated
+    def start(self):
+        self.stopping.clear()
+        self.fix()
+        time.sleep(self.min_seconds)
+        self.fix()
+        self.thread.start()
+        logger.info('Position service started')
+
+    def propagate(self):
+        while not self.stopping.wait(self.interval):
+            self.fix()
+
+    def fix(self):
+        start = time.perf_counter()
+        now = time.time()
+        try:
+            position = iss.coordinates()
+            latitude = position.latitude.degrees
+            longitude = position.longitude.degrees
+            elevation = position.elevation.km
+        except Exception as e:
+            run_log.error(e, 'ISS Position')
+            stage_timers.add('iss_position', time.perf_counter() - start)
+            return
+        stage_timers.add('iss_position', time.perf_counter() - start)
+        with self.lock:
+            fixes = list(self.fixes)
+        if fixes:
+            longitude = fixes[-1][2] + (longitude - fixes[-1][2] + 180) % 360 - 180
+        if len(fixes) >= 2:
+            error = position_error(self.extrapolate(fixes[-2], fixes[-1], now), [latitude, longitude, elevation])
+            self.error.add(error)
+            scale = math.sqrt(self.error_metres / error) if error > 0 else 2
+            self.interval = min(max(self.interval * min(max(0.9 * scale, 0.5), 2), self.min_seconds),
+                                self.max_seconds)
+            self.shortest_interval = min(self.shortest_interval, self.interval)
+            self.longest_interval = max(self.longest_interval, self.interval)
+        with self.lock:
+            self.fixes.append((now, latitude, longitude, elevation, position))
+            self.counts['fixes'] = self.counts['fixes'] + 1
+
+    # Returns the latitude, longitude and elevation at time on the straight line through the positions a and b
+    @staticmethod
+    def extrapolate(a, b, time):
+        fraction = (time - a[0]) / (b[0] - a[0]) if b[0] > a[0] else 1
+        return [a[1] + fraction * (b[1] - a[1]), a[2] + fraction * (b[2] - a[2]), a[3] + fraction * (b[3] - a[3])]
+
+    def position_at(self, time):
+        with self.lock:
+            if not self.fixes:
+                self.counts['missing'] = self.counts['missing'] + 1
+                return None
+            last = self.fixes[-1]
+            if time is None or time - last[0] > self.max_seconds or len(self.fixes) < 2:
+                self.counts['stale'] = self.counts['stale'] + 1
+                return last[4]
+            if time < self.fixes[0][0]:
+                self.counts['stale'] = self.counts['stale'] + 1
+                if self.fixes[0][0] - time > self.max_seconds:
+                    return self.fixes[0][4]
+                a = self.fixes[0]
+                b = self.fixes[1]
+            elif time >= last[0]:
+                a = self.fixes[-2]
+                b = last
+                self.counts['extrapolated'] = self.counts['extrapolated'] + 1
+            else:
+                index = len(self.fixes) - 1
+                while self.fixes[index - 1][0] > time:
+                    index = index - 1
+                a = self.fixes[index - 1]
+                b = self.fixes[index]
+                self.counts['interpolated'] = self.counts['interpolated'] + 1
+        latitude, longitude, elevation = self.extrapolate(a, b, time)
+        return Position(Angle(latitude), Angle((longitude + 180) % 360 - 180), Distance(elevation))
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        logger.info('Position service stopped')
+
+    def counters(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def summary(self):
+        summary = self.counters()
+        summary.update({'interval_seconds': round(self.interval, 3),
+                        'shortest_interval_seconds': round(self.shortest_interval, 3),
+                        'longest_interval_seconds': round(self.longest_interval, 3),
+                        'error_bound_m': self.error_metres,
+                        'extrapolation_error_m': {'p50': round(self.error.percentile(50), 1),
+                                                  'p99': round(self.error.percentile(99), 1),
+                                                  'max': round(self.error.maximum, 1)}})
+        return summary
+
+
+# -------------------------------
+# PIPELINE
+# -------------------------------
+
+# This class is a fixed size buffer which passes readings or rows from one thread of the pipeline to the next. The
+# put method never waits, so the thread taking the sensor readings is never slowed down by the threads after it. If
+# the buffer is full the oldest item is dropped and counted in dropped. It also counts how many items were added, the
+# most items it has held at once in high_water and how many times it was at least three quarters full in
+# backpressure, which shows that the thread after it is not keeping up. The get_all method waits until there is
+# something in the buffer and takes everything out of it at once. Once the thread before it has finished the buffer
+# is closed, so the thread after it knows that there is nothing more to come.
+
+class RingBuffer:
+    def __init__(self, size=BUFFER_SIZE):
+        self.size = size
+        self.items = deque(maxlen=size)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.added = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.backpressure = 0
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) == self.size:
+                self.dropped = self.dropped + 1
+            self.items.append(item)
+            self.added = self.added + 1
+            if len(self.items) > self.high_water:
+                self.high_water = len(self.items)
+            if len(self.items) * 4 >= self.size * 3:
+                self.backpressure = self.backpressure + 1
+            self.condition.notify()
+
+    def get_all(self, timeout=1):
+        with self.condition:
+            if not self.items and not self.closed:
+                self.condition.wait(timeout)
+            items = list(self.items)
+            self.items.clear()
+            return items
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def finished(self):
+        with self.condition:
+            return self.closed and not self.items
+
+    def counters(self):
+        with self.condition:
+            return {'added': self.added, 'dropped': self.dropped, 'high_water': self.high_water,
+                    'backpressure': self.backpressure}
+
+
+# This class runs get_sense_data as a pipeline of three threads, next to the thread of the position service. The
+# sampling thread only reads the sensors when the scheduler says they are due and puts every sample into the raw buffer,
+# so the time between accelerometer readings stays as regular as possible, together with how many magnetometer readings
+# have been taken, so the derive thread can tell which samples have a new magnetometer reading even if the samples
+# before them were dropped from a full buffer. The derive thread takes the samples out of the raw buffer, works out the
+# data with derive_data using the position of the ISS at the time of each sample from the position service, puts the
+# rows into the row buffer and, if statistics are given, adds them to the online statistics. The writer thread takes the
+# rows out of the row buffer and passes them to the data writer. Every thread uses the try-except method so an error is
+# reported in the log and the thread moves on. When stop is called the threads are stopped in order and each buffer is
+# emptied before the next thread stops, so no reading which was taken is lost.
+
+class Pipeline:
+    def __init__(self, data_writer, positions, rates=SAMPLE_RATES, statistics=None):
+        self.data_writer = data_writer
+        self.positions = positions
+        self.statistics = statistics
+        self.raw_buffer = RingBuffer()
+        self.row_buffer = RingBuffer()
+        self.sampling = threading.Event()
+        self.scheduler = Scheduler({'accelerometer': rates['accelerometer'], 'magnetometer': rates['magnetometer']})
+        self.sampling_thread = threading.Thread(target=self.sample, name='Sampling', daemon=True)
+        self.derive_thread = threading.Thread(target=self.derive, name='Derive', daemon=True)
+        self.writer_thread = threading.Thread(target=self.write, name='Writer', daemon=True)
+
+    def start(self):
+        self.sampling.set()
+        self.writer_thread.start()
+        self.derive_thread.start()
+        self.sampling_thread.start()
+        logger.info('Pipeline started')
+
+    def sample(self):
+        mag = None
+        mag_readings = 0
+        while self.sampling.is_set():
+            due = self.scheduler.wait()
+            try:
+                if 'magnetometer' in due:
+                    mag = read_magnetometer()
+                    if mag is not None:
+                        mag_readings = mag_readings + 1
+                if 'accelerometer' in due:
+                    self.raw_buffer.put((read_sensors(mag, read_mag=False), mag_readings))
+            except Exception as e:
+                run_log.error(e, 'Sampling')
+
+    def derive(self):
+        last_mag_reading = 0
+        while not self.raw_buffer.finished():
+            for sample, mag_reading in self.raw_buffer.get_all():
+                start = time.perf_counter()
+                try:
+                    location = self.positions.position_at(sample_time(sample))
+                except Exception as e:
+                    location = None
+                    run_log.error(e, 'ISS Position')
+                stage_timers.add('interpolate', time.perf_counter() - start)
+                start = time.perf_counter()
+                try:
+                    row = derive_data(sample, location)
+                    self.row_buffer.put(row)
+                except Exception as e:
+                    row = None
+                    run_log.error(e, 'Derive')
+                stage_timers.add('derive', time.perf_counter() - start)
+                if self.statistics is not None and row is not None:
+                    try:
+                        self.statistics.add(row, mag_reading != last_mag_reading)
+                    except Exception as e:
+                        run_log.error(e, 'Statistics')
+                last_mag_reading = mag_reading
+
+    def write(self):
+        while not self.row_buffer.finished():
+            for row in self.row_buffer.get_all():
+                start = time.perf_counter()
+                try:
+                    self.data_writer.add_row(row)
+                except Exception as e:
+                    run_log.error(e, 'Writer')
+                stage_timers.add('write', time.perf_counter() - start)
+
+    def stop(self):
+        self.sampling.clear()
+        self.sampling_thread.join()
+        self.raw_buffer.close()
+        self.derive_thread.join()
+        self.row_buffer.close()
+        self.writer_thread.join()
+        logger.info('Pipeline stopped')
+        self.log_counters()
+
+    def counters(self):
+        return {'raw_buffer': self.raw_buffer.counters(), 'row_buffer': self.row_buffer.counters()}
+
+    def log_counters(self):
+        logger.info('Pipeline counters ' + json.dumps(self.counters()))
 
-with open('data.csv', 'w', buffering=1, newline='') as f:
-    try:
-        data_writer = writer(f)
-        logger.info('Data writer variable created')
-    except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
-    try:
-        data_writer.writerow(['DateTime', 'Mag X', 'Mag Y', ' Mag Z', 'Mag Magnitude', 'Acc X', 'Acc Y', 'Acc Z',
-                              'Displacement X', 'Displacement Y', 'Displacement Z', 'ISS Latitude', 'ISS Longitude'
-                                 , 'ISS Elevation'])
-        logger.info('Header Added')
-    except Exception as e:
-        logger.error(f'{e.__class__.__name__}: {e})')
 
 # -------------------------------
 # MAIN WHILE LOOP
 # -------------------------------
 
-# In here we use a while loop which has the condition to run while the variable now_time, which is updated in the
-# loop to have the time currently, is lower than the variable called start_time, which stores the value of the start
-# time, plus 178.5 minutes to allow the program to finish within 3 hours. Inside we use a with-open statement which can
-# only append to the .csv file and cannot overwrite the data in the .csv file. We also use the try-except method to
-# prevent any errors from crashing the code. We also use the log to report any errors that have occurred, we also use
-# it to report that the second data writer has been created and that the data has been added to the .csv file. We
-# also display 'sparkles' on the LED matrix on the sense hat as an indication of the program running and also add to
-# the log file that it has sparkled. We use the os.stat function to find out the file size in bytes of the specified
-# file through the file size,we do that for the csv,log and program file and calculate their total file size and if
-# it is equal to or greater than 2.99999 GB it exits the while loop, in testing the files created and the program
-# itself, will not take more than 0.21 GB of space on the Astro Pi, but we want to be safe and make sure that it will
-# not exceed the 3 GB file space limit on the Astro Pi.
+# In here we use a while loop which has the condition to run while the variable now_time, which is updated in the loop
+# to have the time currently, is lower than the variable called start_time, which stores the value of the start time,
+# plus RUN_MINUTES minutes to allow the program to finish within 3 hours. If ACQUISITION_MODE is 'pipeline' the readings
+# are taken and written by the threads of the pipeline, and the while loop only checks the file size and sparkles.
+# Otherwise every reading is taken in the while loop at the accelerometer rate and passed to the data writer, which
+# holds the rows in memory and writes them to the data file in batches. Every STATUS_SECONDS a status record with the
+# counters of the run is added to the log. Every row is also added to the online statistics, which are written to
+# stats.json every STATS_SECONDS. We also use the try-except method to prevent any errors from crashing the code. We
+# also use the log to report any errors that have occurred, and if VERBOSE_LOGGING is True we also use it to report that
+# the data has been added. We also display 'sparkles' on the LED matrix on the sense hat as an indication of the program
+# running. We use the storage budget to keep track of the total size of the data,log and program file and if it is equal
+# to or greater than 2.99999 GB, or is projected to be within STORAGE_MARGIN_SECONDS of it, it exits the while loop, in
+# testing the files created and the program itself, will not take more than 0.21 GB of space on the Astro Pi, but we
+# want to be safe and make sure that it will not exceed the 3 GB file space limit on the Astro Pi. The loop is inside a
+# try-finally so the pipeline is always stopped and the data writer always writes the rows left in memory and closes the
+# data file, whether the loop finishes because of the time, the file size or an error. The reason the loop finished is
+# stored in stop_reason for the summary.
 
 # The code where it receives the data from the function and writes it to the csv file, also the while loop is based
 # off the Raspberry Pi Foundation Sense HAT Data Logger guide, specifically from the section Writing the data to a file.
 
 # The code where the sense hat sparkles it is based off the Raspberry Pi Foundation Sense HAT Random Sparkles guide.
 
-now_time = datetime.now()
-while now_time < start_time + timedelta(minutes=178.5):
+def storage_full():
+    start = time.perf_counter()
+    full = False
+    try:
+        if storage.full():
+            logger.info('Storage limit reached ' + json.dumps(storage.summary()))
+            full = True
+    except Exception as e:
+        run_log.error(e, 'Storage')
+    stage_timers.add('storage', time.perf_counter() - start)
+    return full
+
+
+def write_statistics(statistics, path, force=False):
+    if not force and not statistics.write_due():
+        return
     try:
-        TotalFileSize = os.stat(base_folder / "data.csv").st_size
-        TotalFileSize = TotalFileSize + os.stat(base_folder / "HHorizons.log").st_size
-        TotalFileSize = TotalFileSize + os.stat(base_folder / "main.py").st_size
-        if TotalFileSize >= 2999990000:
-            break
+        statistics.write(path)
+    except Exception as e:
+        run_log.error(e, 'Statistics')
+
+
+def sparkle():
+    start = time.perf_counter()
+    try:
+        x = randint(0, 7)
+        y = randint(0, 7)
+        r = randint(0, 255)
+        g = randint(0, 255)
+        b = randint(0, 255)
+        sense.set_pixel(x, y, r, g, b)
+        run_log.trace('Sparkled')
+    except Exception as e:
+        run_log.error(e, 'Sparkle')
+    stage_timers.add('sparkle', time.perf_counter() - start)
+
+
+# -------------------------------
+# STARTING THE PROGRAM
+# -------------------------------
+
+# The settings above can be changed for a run when the program is started, for example
+# python main.py --backend replay --replay flight/data.csv --speed 0 --minutes 5 --output replay
+# runs for 5 minutes taking the readings from a recorded data file as fast as they can be worked out and written, and
+# stores the new data file, log and summary in the replay folder. On the Astro Pi the program is started with no
+# arguments, so the settings above are used.
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Take the HHorizons readings and store them in the output folder.')
+    parser.add_argument('--backend', default=SENSOR_BACKEND, choices=BACKENDS,
+                        help='where the readings come from')
+    parser.add_argument('--replay', default=REPLAY_FILE,
+                        help='data file or data folder played back by the replay backend')
+    parser.add_argument('--speed', type=float, default=REPLAY_SPEED,
+                        help='how many times faster the replay backend plays back the data file, 0 plays it back as '
+                             'fast as the readings are taken')
+    parser.add_argument('--minutes', type=float, default=RUN_MINUTES, help='how long the readings are taken for')
+    parser.add_argument('--mode', default=ACQUISITION_MODE, choices=['loop', 'pipeline'],
+                        help='how the readings are taken')
+    parser.add_argument('--format', default=RECORDING_FORMAT, choices=['csv', 'binary'],
+                        help='how the readings are stored')
+    parser.add_argument('--layout', default=RECORDING_LAYOUT, choices=['segments', 'single'],
+                        help='whether the readings are split into segments in the data folder or stored in one file')
+    parser.add_argument('--rate', type=float, default=SAMPLE_RATES['accelerometer'],
+                        help='accelerometer readings a second, 0 takes them as fast as possible')
+    parser.add_argument('--output', default=base_folder, help='folder the data, log and summary are stored in')
+    arguments = parser.parse_args(argv)
+    if arguments.backend == 'replay':
+        replay = Path(arguments.replay).resolve()
+        data_folder = (Path(arguments.output) / "data").resolve()
+        if replay == (Path(arguments.output) / "data.csv").resolve() or data_folder in (replay, replay.parent):
+            parser.error('the replayed data would be written to, choose a different --output folder')
+    return arguments
+
+
+# This is the main function which runs the experiment. It creates the log, the sensor backend, the integrator, the
+# data writer and the storage budget, then takes the readings in the main while loop and finishes the program. It
+# returns the summary of the run.
+
+def main(argv=None):
+    global sense, iss, integrator, storage, run_log, stage_timers
+    arguments = parse_arguments(argv)
+    rates = dict(SAMPLE_RATES)
+    rates['accelerometer'] = arguments.rate or None
+    output_folder = Path(arguments.output)
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    # -------------------------------
+    # INITIALISING VARIABLES
+    # -------------------------------
+
+    # Creates the variable start_time at which the program starts
+    start_time = datetime.now()
+
+    # Creates the log file under the file path of the output_folder
+    logfile(output_folder / "HHorizons.log")
+
+    # Adds to the log the start time
+    logger.info(start_time)
+
+    # Creates the sense variable with the properties of the sense hat, and the iss variable which gives the position
+    # of the ISS, from the chosen backend
+    sense, iss = create_backend(arguments.backend, arguments.replay, arguments.speed)
+    logger.info('Sensor backend ' + arguments.backend)
+
+    # Sets the orientation of the text displayed to be correct
+    sense.set_rotation(270)
+
+    # Displays on the LED Matrix the string Hello World as per computer science tradition
+    sense.show_message('Hello World')
+
+    # Adds to log that the time variables and base folders have been created
+    logger.info('Time Variables & Base Folders Created')
+
+    # Creates the run_log variable which is used for logging while the readings are being taken, and the
+    # stage_timers variable which times the stages of taking the readings
+    run_log = RunLog()
+    stage_timers = StageTimers()
+
+    # Creates the integrator variable and gets the accelerometer values and the time for which the accelerometer took
+    # the readings twice, which gives the integrator the previous two accelerations it needs before it can calculate
+    # the first displacement
+    integrator = DisplacementIntegrator()
+    for reading in range(2):
+        acc = sense.get_accelerometer_raw()
+        integrator.update([acc["x"], acc["y"], acc["z"]], time.time())
+
+    # -------------------------------
+    # WRITING THE HEADER
+    # -------------------------------
+
+    # Creates the segmented writer for the data folder if the layout is 'segments', which carries on in a new segment
+    # after the ones recorded by earlier runs and adds the header to every segment. If the layout is 'single' it creates
+    # the data writer for data.csv, which overwrites any old file and adds the header for the data collected, or the
+    # binary data writer for data.bin if the format is 'binary'. The data writer keeps the file open for the rest of
+    # the run. We also use the try except method to prevent any errors from crashing the program. Also, we add to the
+    # log that it has created the data writer and that the header has been added.
+
+    # The header below is based off the Raspberry Pi Foundation Sense HAT Data Logger guide, specifically from the
+    # section Adding a header to the CSV file.
+
+    try:
+        if arguments.layout == 'segments':
+            data_writer = SegmentedWriter(output_folder / "data", DATA_HEADER, arguments.format)
+            logger.info('Recording segment ' + str(data_writer.number) + ', ' + str(data_writer.recovered) +
+                        ' unfinished segments recovered')
+        elif arguments.format == 'binary':
+            data_writer = BinaryDataWriter(output_folder / "data.bin", header=DATA_HEADER)
+        else:
+            data_writer = DataWriter(output_folder / "data.csv", header=DATA_HEADER)
+        logger.info('Data writer variable created')
+        logger.info('Header Added')
     except Exception as e:
         logger.error(f'{e.__class__.__name__}: {e})')
-    with open('data.csv', 'a', buffering=1, newline='') as f:
+
+    # Creates the storage budget, which keeps track of the size of the output folder and the program files
+    try:
+        storage = StorageBudget(data_writer, [output_folder], program_files(output_folder))
+        logger.info('Storage budget created')
+    except Exception as e:
+        logger.error(f'{e.__class__.__name__}: {e})')
+
+    # -------------------------------
+    # TAKING THE READINGS
+    # -------------------------------
+
+    # Takes the readings in the main while loop, which is described above the storage_full and sparkle functions
+
+    pipeline = None
+    schedulers = []
+    stop_reason = 'error'
+    positions = PositionService(rates['position'])
+    statistics = OnlineStatistics()
+    now_time = datetime.now()
+    try:
+        positions.start()
+        if arguments.mode == 'pipeline':
+            pipeline = Pipeline(data_writer, positions, rates, statistics)
+            schedulers = [pipeline.scheduler]
+            pipeline.start()
+            stop_reason = 'time'
+            while now_time < start_time + timedelta(minutes=arguments.minutes):
+                if storage_full():
+                    stop_reason = 'storage'
+                    break
+                sparkle()
+                if run_log.status_due():
+                    run_log.status({'rows_written': data_writer.rows_written, 'storage': storage.summary(),
+                                    'pipeline': pipeline.counters(), 'position': positions.counters()})
+                write_statistics(statistics, output_folder / "stats.json")
+                time.sleep(1)
+                now_time = datetime.now()
+        else:
+            scheduler = Scheduler({'accelerometer': rates['accelerometer']})
+            schedulers = [scheduler]
+            stop_reason = 'time'
+            while now_time < start_time + timedelta(minutes=arguments.minutes):
+                if storage_full():
+                    stop_reason = 'storage'
+                    break
+                sparkle()
+                scheduler.wait()
+                try:
+                    data = get_sense_data(positions)
+                    run_log.trace('Data Variable created and got the data')
+                    start = time.perf_counter()
+                    data_writer.add_row(data)
+                    stage_timers.add('write', time.perf_counter() - start)
+                    run_log.trace('Data added')
+                    statistics.add(data)
+                except Exception as e:
+                    run_log.error(e, 'Data')
+                if run_log.status_due():
+                    run_log.status({'rows_written': data_writer.rows_written, 'storage': storage.summary(),
+                                    'position': positions.counters()})
+                write_statistics(statistics, output_folder / "stats.json")
+                now_time = datetime.now()
+    finally:
         try:
-            x = randint(0, 7)
-            y = randint(0, 7)
-            r = randint(0, 255)
-            g = randint(0, 255)
-            b = randint(0, 255)
-            sense.set_pixel(x, y, r, g, b)
-            logger.info('Sparkled')
+            if pipeline is not None:
+                pipeline.stop()
         except Exception as e:
             logger.error(f'{e.__class__.__name__}: {e})')
         try:
-            data_writer = writer(f)
-            logger.info('Data Writer 2 Created')
+            positions.stop()
         except Exception as e:
             logger.error(f'{e.__class__.__name__}: {e})')
         try:
-            data = get_sense_data()
-            logger.info('Data Variable created and got the data')
-            data_writer.writerow(data)
-            logger.info('Data added')
-            now_time = datetime.now()
+            data_writer.close()
+            logger.info('Data writer closed')
         except Exception as e:
             logger.error(f'{e.__class__.__name__}: {e})')
+        write_statistics(statistics, output_folder / "stats.json", force=True)
 
-# -------------------------------
-# Finishing the program
-# -------------------------------
+    # -------------------------------
+    # Finishing the program
+    # -------------------------------
+
+    # Displays on the LED Matrix the string Finished
+    sense.show_message('Finished')
+
+    # Stores the current time in the variable FinishTime
+    FinishTime = datetime.now()
 
-# Displays on the LED Matrix the string Finished
-sense.show_message('Finished')
+    # Adds to the log file the value of the variable FinishTime and the string FinishTime
+    logger.info('Finish Time')
+    logger.info(FinishTime)
+
+    # Adds to the log file and to summary.json a summary of the run, which has why it finished, how many rows were
+    # written, the target rate, achieved rate, jitter percentiles and missed deadlines of every sensor, the counters of
+    # the pipeline, how the positions of the ISS were worked out, how much of the storage budget was used, the online
+    # statistics of every channel and how long each stage of taking the readings took
+    run_summary = None
+    try:
+        storage.check()
+        run_summary = {'start_time': str(start_time), 'finish_time': str(FinishTime),
+                       'acquisition_mode': arguments.mode, 'backend': arguments.backend, 'stop_reason': stop_reason,
+                       'rows_written': data_writer.rows_written, 'storage': storage.summary(), 'channels': {}}
+        for scheduler in schedulers:
+            run_summary['channels'].update(scheduler.summary())
+        if pipeline is not None:
+            run_summary['pipeline'] = pipeline.counters()
+        run_summary['position'] = positions.summary()
+        if isinstance(data_writer, SegmentedWriter):
+            run_summary['recording'] = data_writer.summary()
+        run_summary['statistics'] = statistics.summary()
+        run_summary['log'] = run_log.summary()
+        run_summary['stages'] = stage_timers.summary()
+        logger.info('Stage timings ' + json.dumps(stage_timers.compact()))
+        with open(output_folder / "summary.json", 'w') as f:
+            json.dump(run_summary, f, indent=1)
+        logger.info('Run summary ' + json.dumps(run_summary))
+    except Exception as e:
+        logger.error(f'{e.__class__.__name__}: {e})')
 
-# Stores the current time in the variable FinishTime
-FinishTime = datetime.now()
+    # Clears the sense hat LED Matrix
+    sense.clear()
 
-# Adds to the log file the value of the variable FinishTime and the string FinishTime
-logger.info('Finish Time')
-logger.info(FinishTime)
+    return run_summary
 
-# Clears the sense hat LED Matrix
-sense.clear()
 
-# End of Program
+if __name__ == '__main__':
+    main()